@@ -0,0 +1,118 @@
+import math
+from hashlib import blake2b
+from typing import Optional
+
+
+class BloomFilter:
+    """
+    Bloom filter over strings. `in` returning False means the key was never added;
+    True means it probably was (false positives at about `false_positive_rate`
+    while no more than `capacity` keys are added). Keys can not be removed.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        self.capacity = max(int(capacity), 1)
+        self.false_positive_rate = false_positive_rate
+        # Optimal size and number of hash functions for the capacity and rate
+        self.size = max(int(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> range:
+        # Double hashing: the k positions h1 + i * h2 come from one 128-bit digest.
+        # Returned as a range (taken modulo size by the caller), cheaper than a generator.
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return range(h1, h1 + self.hashes * h2, h2)
+
+    def add(self, key: str):
+        bits, size = self.bits, self.size
+        for position in self._positions(key):
+            position %= size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits, size = self.bits, self.size
+        for position in self._positions(key):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+    def estimated_false_positive_rate(self) -> float:
+        """False positive rate for the number of keys added so far."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class UserKeyFilter:
+    """
+    Bloom filter of registered emails (normalized) and usernames, so lookups of
+    unknown keys can be answered without a query. Filled by
+    UserRepository.build_filter() and kept current by its commits.
+
+    Only this process's writes are added: users created by other workers or
+    processes are reported as missing until the next rebuild.
+    """
+
+    def __init__(self, capacity: int = 0, false_positive_rate: float = 0.01, min_capacity: int = 10000):
+        # Users the filter is sized for, 0 = twice the users at build time
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.min_capacity = min_capacity
+        # None until the first build, lookups are not filtered before that
+        self.bloom: Optional[BloomFilter] = None
+        # Filter being built, receives the writes made during a rebuild
+        self.building: Optional[BloomFilter] = None
+        self.rebuilds = 0
+        self.rebuild_seconds = 0.0
+        self.skipped_queries = 0
+
+    def might_exist(self, kind: str, key: str) -> bool:
+        if self.bloom is None or f"{kind}:{key}" in self.bloom:
+            return True
+        self.skipped_queries += 1
+        return False
+
+    def add(self, kind: str, key: str):
+        for bloom in (self.bloom, self.building):
+            if bloom is not None:
+                bloom.add(f"{kind}:{key}")
+
+    def start_build(self, users: int) -> BloomFilter:
+        capacity = self.capacity or max(2 * users, self.min_capacity)
+        # Every user adds an email and a username
+        self.building = BloomFilter(2 * capacity, self.false_positive_rate)
+        return self.building
+
+    def finish_build(self, bloom: BloomFilter, seconds: float):
+        self.bloom = bloom
+        self.building = None
+        self.rebuilds += 1
+        self.rebuild_seconds = seconds
+
+    def abort_build(self):
+        self.building = None
+
+    def over_capacity(self) -> bool:
+        return self.bloom is not None and self.bloom.count > self.bloom.capacity
+
+    def stats(self) -> dict:
+        bloom = self.bloom
+        return {
+            "keys": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "memory_bytes": bloom.memory_bytes if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "false_positive_rate": self.false_positive_rate,
+            "estimated_false_positive_rate": bloom.estimated_false_positive_rate() if bloom else 0.0,
+            "rebuilds": self.rebuilds,
+            "rebuild_seconds": self.rebuild_seconds,
+            "skipped_queries": self.skipped_queries,
+        }
@@ -0,0 +1,101 @@
+import time
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+# SQLite pragma presets, selected with `profile` in [database].
+# Single keys in [database] override the preset.
+PROFILES = {
+    # SQLite defaults (rollback journal, synchronous=FULL)
+    "default": {},
+    # WAL lets readers run during a write, FULL keeps every commit durable
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+    # WAL with NORMAL sync only fsyncs at checkpoints; a power loss may drop the
+    # last commits but never corrupts the database
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "busy_timeout": 5000,
+    },
+}
+
+PRAGMAS = ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout")
+POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout", "pool_recycle", "pool_pre_ping")
+
+
+def pragma_settings(conf: dict) -> dict:
+    """
+    Pragmas to apply on every new connection, from the profile and explicit keys of [database].
+    """
+    profile = conf.get("profile", "default")
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown database profile: {profile}")
+    settings = dict(PROFILES[profile])
+    settings.update((name, conf[name]) for name in PRAGMAS if name in conf)
+    return settings
+
+
+def create_engine(conf: dict) -> AsyncEngine:
+    """
+    Builds the async engine from a [database] config section.
+    """
+    options = {name: conf[name] for name in POOL_OPTIONS if name in conf}
+    engine = create_async_engine(conf["url"], echo=conf.get("echo", False), **options)
+
+    if engine.dialect.name == "sqlite":
+        pragmas = pragma_settings(conf)
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return engine
+
+
+def instrument_queries(engine: AsyncEngine, histogram):
+    """
+    Records the duration of every statement in `histogram`, labelled with the
+    statement type (select, insert, update, ...).
+    """
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "other"
+        histogram.observe(elapsed, operation)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def drop_timer(context):
+        starts = context.connection.info.get("query_start") if context.connection else None
+        if starts:
+            starts.pop()
+
+
+async def effective_settings(engine: AsyncEngine) -> dict:
+    """
+    Reads back the pragmas of a live connection and the pool configuration.
+    """
+    settings = {}
+    if engine.dialect.name == "sqlite":
+        async with engine.connect() as conn:
+            for name in PRAGMAS:
+                settings[name] = (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+    pool = engine.pool
+    settings["pool"] = type(pool).__name__
+    if hasattr(pool, "size"):
+        settings["pool_size"] = pool.size()
+    if hasattr(pool, "_max_overflow"):
+        settings["max_overflow"] = pool._max_overflow
+    settings["pool_pre_ping"] = pool._pre_ping
+    return settings
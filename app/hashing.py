@@ -0,0 +1,91 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from metrics import Histogram
+from profiler import span
+from utils import hash_password, verify_password, needs_rehash, ALGORITHMS, DEFAULT_COST
+
+
+class HashingOverloadedError(Exception):
+    """Raised when too many hashing jobs are already waiting."""
+
+
+class HashingService:
+    """
+    Runs password hashing and verification in a worker pool, so a slow KDF
+    does not block the event loop.
+    At most `max_pending` jobs may be queued or running; further calls fail
+    fast with HashingOverloadedError instead of piling up.
+    New hashes use `algorithm` with work factor `cost` (see utils.hash_password);
+    existing hashes of any supported format can still be verified.
+    """
+
+    def __init__(
+        self,
+        workers: int = 0,
+        max_pending: int = 256,
+        executor: str = "process",
+        latency: Optional[Histogram] = None,
+        algorithm: str = "sha",
+        cost: Optional[int] = None,
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.cost = cost if cost is not None else DEFAULT_COST[algorithm]
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.executor_type = executor
+        self.executor: Optional[Executor] = None
+        self.pending = 0
+        self.rejected = 0
+        # Optional histogram of job durations (incl. waiting for a worker), by function name
+        self.latency = latency
+
+    def start(self):
+        if self.executor_type == "process":
+            # Forking avoids re-importing the app in every worker. Call start() before
+            # anything starts threads (aiosqlite connections, executors): the children
+            # only get the forking thread, locks held by other threads stay locked there.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if "fork" in methods else None)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            self.executor.submit(int).result()
+        elif self.executor_type == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            raise ValueError(f"Unknown hashing executor: {self.executor_type}")
+
+    def shutdown(self, wait: bool = False):
+        if self.executor:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+            self.executor = None
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HashingOverloadedError()
+        if self.executor is None:
+            self.start()
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            with span(fn.__name__):
+                return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+            if self.latency:
+                self.latency.observe(time.perf_counter() - start, fn.__name__)
+
+    async def hash_password(self, password: str) -> str:
+        return await self._run(hash_password, password, None, self.algorithm, self.cost)
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        """True if the hash was made with other parameters than new hashes get."""
+        return needs_rehash(stored_hash, self.algorithm, self.cost)
+
+    async def verify_password(self, stored_hash: str, password: str) -> bool:
+        return await self._run(verify_password, stored_hash, password)
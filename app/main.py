@@ -1,41 +1,242 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from datetime import datetime, timezone
 from models import *
-from user_repository import UserRepository
-from rate_limiter import RateLimiter
-from utils import hash_password, verify_password, is_valid_password, is_valid_email, is_valid_username
-from sqlalchemy.ext.asyncio import create_async_engine
+from user_repository import UserRepository, DuplicateUserError
+from user_cache import UserCache
+from bloom_filter import UserKeyFilter
+from rate_limiter import SqliteRateLimiter, create_rate_limiter
+from utils import is_valid_password, is_valid_email, is_valid_username, normalize_email
+from hashing import HashingService, HashingOverloadedError
+from db import create_engine, effective_settings, instrument_queries
+from metrics import MetricsRegistry, MetricsMiddleware
+from profiler import ProfilerMiddleware, ProfileWriter, span
 from session_manager import SessionManager
-import uuid
+from session_store import create_session_store
+from signed_tokens import TokenSigner, signing_key
+from write_behind import LastAccessBuffer
+import asyncio
+import logging
+import os
 import tomllib
 
 # --- Load Config ---
-with open("./app/config.toml", "rb") as f:
+# GATEKEEPER_CONFIG erlaubt eine andere Konfiguration, z.B. fuer Benchmarks
+with open(os.environ.get("GATEKEEPER_CONFIG", "./app/config.toml"), "rb") as f:
     config = tomllib.load(f)
 
-db_url = config["database"]["url"]
-echo_db = config["database"].get("echo", False)
+db_conf = config["database"]
 valid_tokens = config["auth"]["valid_tokens"]
 require_api_token = config["auth"]["require_api_token"]
+token_mode = config["auth"].get("token_mode", "opaque")
 rate_limit_conf = config["ratelimit"]
+session_conf = config.get("session", {})
+hashing_conf = config.get("hashing", {})
+cache_conf = config.get("cache", {})
+filter_conf = config.get("user_filter", {})
+write_behind_conf = config.get("write_behind", {})
+max_batch_size = config.get("api", {}).get("max_batch_size", 100)
+metrics_conf = config.get("metrics", {})
+profiler_conf = config.get("profiler", {})
+
+logger = logging.getLogger("uvicorn.error")
 
 # --- Setup ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Datenbanktabellen erstellen
-    async with engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
+    # Hashing-Prozesse zuerst forken, solange noch keine anderen Threads laufen (aiosqlite)
+    hasher.start()
+    # Startup: Datenbanktabellen erstellen und bestehende Datenbanken migrieren
+    await repo.init_db()
+    logger.info("Database settings: %s", await effective_settings(engine))
+    # Filter der bekannten Emails/Usernames aufbauen, bevor Requests bedient werden
+    if key_filter:
+        await repo.build_filter()
+        logger.info("User key filter: %s", key_filter.stats())
+    # Persistierte Sessions wiederherstellen, damit ein Neustart niemanden ausloggt
+    restored = session.restore()
+    if restored:
+        logger.info("Restored %d sessions", restored)
+    # Abgelaufene Sessions im Hintergrund entfernen
+    expiry_task = asyncio.create_task(
+        session.run_expiry_loop(session_conf.get("sweep_interval", 5), session_conf.get("sweep_batch_size", 10000))
+    )
+    flush_task = asyncio.create_task(last_access_buffer.run()) if last_access_buffer else None
+    rebuild_interval = filter_conf.get("rebuild_interval", 3600)
+    rebuild_task = asyncio.create_task(
+        repo.run_filter_rebuild(rebuild_interval)
+    ) if key_filter and rebuild_interval else None
     yield
-    
+    expiry_task.cancel()
+    if rebuild_task:
+        rebuild_task.cancel()
+    if flush_task:
+        flush_task.cancel()
+        await asyncio.gather(flush_task, return_exceptions=True)
+        await last_access_buffer.flush()
+    session.store.close()
+    login_rate_limiter.close()
+    if ip_rate_limiter:
+        ip_rate_limiter.close()
+    hasher.shutdown()
+
 app = FastAPI(lifespan=lifespan)
-engine = create_async_engine(db_url, echo=echo_db)
-repo = UserRepository(engine)
-login_rate_limiter = RateLimiter(
-    max_attempts=rate_limit_conf["max_attempts"],
-    window_seconds=rate_limit_conf["window_seconds"]
+engine = create_engine(db_conf)
+user_cache = UserCache(
+    max_entries=cache_conf.get("max_entries", 10000),
+    ttl_seconds=cache_conf.get("ttl_seconds", 10)
+) if cache_conf.get("enabled", False) else None
+key_filter = UserKeyFilter(
+    capacity=filter_conf.get("capacity", 0),
+    false_positive_rate=filter_conf.get("false_positive_rate", 0.01)
+) if filter_conf.get("enabled", False) else None
+repo = UserRepository(engine, cache=user_cache, key_filter=key_filter)
+last_access_buffer = LastAccessBuffer(
+    repo,
+    flush_interval_ms=write_behind_conf.get("flush_interval_ms", 500),
+    max_entries=write_behind_conf.get("max_entries", 1000)
+) if write_behind_conf.get("enabled", False) else None
+login_rate_limiter = create_rate_limiter(rate_limit_conf)
+ip_rate_limiter = create_rate_limiter(rate_limit_conf, "ip") if rate_limit_conf.get("ip_max_attempts", 0) else None
+session = SessionManager(
+    timeout=session_conf.get("timeout", 1800),
+    store=create_session_store(session_conf),
+    signer=TokenSigner(signing_key(config["auth"])) if token_mode == "signed" else None
+)
+
+# --- Metrics ---
+metrics = MetricsRegistry() if metrics_conf.get("enabled", False) else None
+if metrics:
+    app.add_middleware(
+        MetricsMiddleware,
+        histogram=metrics.histogram(
+            "gatekeeper_request_duration_seconds", "HTTP request latency", ("method", "route", "status")
+        ),
+        exclude=("/metrics",)
+    )
+    instrument_queries(engine, metrics.histogram(
+        "gatekeeper_db_query_duration_seconds", "Database statement latency", ("operation",)
+    ))
+    metrics.gauge("gatekeeper_live_sessions", "Sessions in the session store", lambda: session.live_sessions)
+    metrics.gauge(
+        "gatekeeper_rate_limiter_keys", "Emails tracked by the login rate limiter",
+        login_rate_limiter.tracked_keys
+    )
+    if ip_rate_limiter:
+        metrics.gauge(
+            "gatekeeper_ip_rate_limiter_keys", "Client addresses tracked by the login rate limiter",
+            ip_rate_limiter.tracked_keys
+        )
+    metrics.gauge(
+        "gatekeeper_db_pool_checked_out", "Database connections in use",
+        lambda: engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else 0
+    )
+    metrics.gauge(
+        "gatekeeper_user_lookups_coalesced_total", "User lookups answered by a concurrent identical query",
+        lambda: repo.coalesced_queries, type="counter"
+    )
+    if user_cache:
+        metrics.gauge(
+            "gatekeeper_user_cache_hits_total", "User lookups answered by the user cache",
+            lambda: user_cache.stats()["hits"], type="counter"
+        )
+        metrics.gauge(
+            "gatekeeper_user_cache_misses_total", "User lookups not found in the user cache",
+            lambda: user_cache.stats()["misses"], type="counter"
+        )
+        metrics.gauge(
+            "gatekeeper_user_cache_entries", "Users in the user cache",
+            lambda: user_cache.stats()["entries"]
+        )
+    if key_filter:
+        metrics.gauge(
+            "gatekeeper_user_filter_memory_bytes", "Size of the user key filter",
+            lambda: key_filter.stats()["memory_bytes"]
+        )
+        metrics.gauge(
+            "gatekeeper_user_filter_false_positive_rate", "Estimated false positive rate of the user key filter",
+            lambda: key_filter.stats()["estimated_false_positive_rate"]
+        )
+        metrics.gauge(
+            "gatekeeper_user_filter_rebuild_seconds", "Duration of the last user key filter build",
+            lambda: key_filter.rebuild_seconds
+        )
+        metrics.gauge(
+            "gatekeeper_user_filter_skipped_queries_total", "Lookups of unknown users answered without a query",
+            lambda: key_filter.skipped_queries, type="counter"
+        )
+    metrics.gauge("gatekeeper_hashing_pending", "Queued and running hashing jobs", lambda: hasher.pending)
+    metrics.gauge(
+        "gatekeeper_hashing_rejected_total", "Hashing jobs rejected as overloaded",
+        lambda: hasher.rejected, type="counter"
+    )
+
+# --- Profiler ---
+if profiler_conf.get("enabled", False):
+    app.add_middleware(
+        ProfilerMiddleware,
+        writer=ProfileWriter(profiler_conf.get("directory", "./profiles"), profiler_conf.get("max_files", 100)),
+        slow_ms=profiler_conf.get("slow_ms", 250),
+        sample_rate=profiler_conf.get("sample_rate", 0.0),
+        interval_ms=profiler_conf.get("interval_ms", 10),
+        sample_after=profiler_conf.get("sample_after", 0.5),
+        phases=metrics.histogram(
+            "gatekeeper_request_phase_duration_seconds", "Time spent per request phase", ("route", "phase")
+        ) if metrics else None,
+        exclude=("/metrics",)
+    )
+
+hasher = HashingService(
+    workers=hashing_conf.get("workers", 0),
+    max_pending=hashing_conf.get("max_pending", 256),
+    executor=hashing_conf.get("executor", "process"),
+    latency=metrics.histogram(
+        "gatekeeper_hashing_duration_seconds", "Password hash/verify latency incl. queueing", ("function",)
+    ) if metrics else None,
+    algorithm=hashing_conf.get("algorithm", "sha"),
+    cost=hashing_conf.get("cost")
 )
-session = SessionManager(timeout=1800)
+rehash_on_login = hashing_conf.get("rehash_on_login", True)
+
+@app.exception_handler(HashingOverloadedError)
+async def hashing_overloaded_handler(request: Request, exc: HashingOverloadedError):
+    return JSONResponse(status_code=503, content={"detail": "Server busy, try again later"})
+
+if metrics:
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def duplicate_detail(error: DuplicateUserError) -> str:
+    if error.field == "email":
+        return "Email already registered"
+    return "Username already taken"
+
+async def allow_attempt(limiter, identifier: str) -> bool:
+    if isinstance(limiter, SqliteRateLimiter):
+        # Can wait up to busy_timeout for another worker's write lock, keep that off the loop
+        return await asyncio.to_thread(limiter.allow_attempt, identifier)
+    return limiter.allow_attempt(identifier)
+
+async def session_call(fn, *args):
+    if session.store.blocking:
+        # The SQLite store can wait up to busy_timeout for another worker's write lock
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+def build_user_data(user: UserModel, is_active: bool) -> dict:
+    last_access = user.last_access
+    if last_access_buffer:
+        # Logins that are not flushed yet
+        last_access = last_access_buffer.get(user.id) or last_access
+    return {
+        "username": user.username,
+        "email": user.email,
+        "registered_at": user.registered_at,
+        "last_access": last_access,
+        "is_active": is_active,
+    }
 
 
 # --- Endpoints ---
@@ -45,9 +246,6 @@ async def register_user(data: RegisterRequest):
         raise HTTPException(status_code=401, detail="Invalid API token")
     if not is_valid_email(data.email):
         raise HTTPException(status_code=400, detail="Invalid email format")
-    existing = await repo.get_user_by_email(data.email)
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
     if not is_valid_username(data.username):
         raise HTTPException(status_code=400, detail="Invalid username format")
     if not is_valid_password(data.password):
@@ -55,13 +253,18 @@ async def register_user(data: RegisterRequest):
             status_code=400,
             detail="Password must be at least 7 characters long and include one uppercase letter, one lowercase letter, and one digit"
         )
-    hashed_pw = hash_password(data.password)
+    hashed_pw = await hasher.hash_password(data.password)
     user = UserModel(
         username=data.username,
         email=data.email,
         hashed_password=hashed_pw,
     )
-    await repo.save(user)
+    # Existing emails and usernames are rejected by the unique indexes
+    try:
+        async with repo.unit_of_work() as uow:
+            uow.add(user)
+    except DuplicateUserError as e:
+        raise HTTPException(status_code=400, detail=duplicate_detail(e))
     return {"status": "success", "message": "User registered"}
 
 @app.post("/get-user-data")
@@ -82,42 +285,67 @@ async def get_user_data(data: GetUserDataRequest):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_id = user.id
-    username = user.username
-    email = user.email
-    registered_at = user.registered_at
-    last_access = user.last_access
-    user_is_active = any(session.is_session_active(token) for token in session.tokens_by_id.get(user_id, []))
-    user_data = {
-        "username": username,
-        "email": email,
-        "registered_at": registered_at,
-        "last_access": last_access,
-        "is_active": user_is_active,
-    }
-
+    user_data = build_user_data(user, await session_call(session.is_user_active, user.id))
     return {"status": "success", "user_data": user_data}
 
+@app.post("/get-users-data")
+async def get_users_data(data: GetUsersDataRequest):
+    if data.api_token not in valid_tokens and require_api_token:
+        raise HTTPException(status_code=401, detail="Invalid API token")
+    requested = len(data.ids) + len(data.emails) + len(data.usernames)
+    if requested == 0:
+        raise HTTPException(status_code=400, detail="At least one of ids, emails, or usernames is required.")
+    if requested > max_batch_size:
+        raise HTTPException(status_code=400, detail=f"At most {max_batch_size} users per request")
+
+    # One IN query per key type, users matched by several keys are returned once
+    users = {}
+    if data.ids:
+        users.update((user.id, user) for user in await repo.get_users_by_ids(data.ids))
+    if data.emails:
+        users.update((user.id, user) for user in await repo.get_users_by_emails(data.emails))
+    if data.usernames:
+        users.update((user.id, user) for user in await repo.get_users_by_usernames(data.usernames))
+
+    active = await session_call(session.active_users, list(users))
+    users_data = [
+        {"id": user_id, **build_user_data(user, user_id in active)}
+        for user_id, user in users.items()
+    ]
+    return {"status": "success", "users": users_data}
+
 @app.post("/login-user")
-async def login_user(data: LoginRequest):
+async def login_user(data: LoginRequest, request: Request):
     if data.api_token not in valid_tokens and require_api_token:
         raise HTTPException(status_code=401, detail="Invalid API token")
-    
-    if not login_rate_limiter.allow_attempt(data.email):
-        raise HTTPException(status_code=429, detail="Too many login attempts")
 
-    user = await repo.get_user_by_email(data.email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    if not verify_password(user.hashed_password, data.password):
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    user_id = user.id
+    # Client address as seen by uvicorn, X-Forwarded-For is honoured for forwarded_allow_ips
+    with span("rate_limit"):
+        if ip_rate_limiter and request.client and not await allow_attempt(ip_rate_limiter, request.client.host):
+            raise HTTPException(status_code=429, detail="Too many login attempts")
+        if not await allow_attempt(login_rate_limiter, normalize_email(data.email)):
+            raise HTTPException(status_code=429, detail="Too many login attempts")
 
-    token = str(uuid.uuid4())
-    session.create_session(token, user_id)
+    async with repo.unit_of_work() as uow:
+        user = await uow.get_user_by_email(data.email)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        if not await hasher.verify_password(user.hashed_password, data.password):
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        # Upgrade hashes made with an old algorithm or work factor while the password is at hand
+        if rehash_on_login and hasher.needs_rehash(user.hashed_password):
+            try:
+                user.hashed_password = await hasher.hash_password(data.password)
+            except HashingOverloadedError:
+                # Only an upgrade: the login succeeds, the hash is upgraded on a later login
+                pass
+        user_id = user.id
+        if last_access_buffer:
+            last_access_buffer.record(user_id, datetime.now(timezone.utc))
+        else:
+            user.last_access = datetime.now(timezone.utc)
 
-    user.last_access = datetime.now(timezone.utc)
-    await repo.update(user)
+    token = await session_call(session.issue_session, user_id)
     return {"status": "success", "session_token": token, "user_id": user_id, "message": "Logged in"}
 
 @app.post("/logout-user")
@@ -125,56 +353,74 @@ async def logout_user(data: LogoutRequest):
     if data.api_token not in valid_tokens and require_api_token:
         raise HTTPException(status_code=401, detail="Invalid API token")
 
-    if not session.is_session_active(data.session_token):
+    if not await session_call(session.is_session_active, data.session_token):
         raise HTTPException(status_code=401, detail="Invalid session token")
 
-    session.close_session_for_token(data.session_token)
+    await session_call(session.close_session_for_token, data.session_token)
     return {"status": "success", "message": "Logged out"}
 
+@app.post("/validate-session")
+async def validate_session(data: ValidateSessionRequest):
+    if data.api_token not in valid_tokens and require_api_token:
+        raise HTTPException(status_code=401, detail="Invalid API token")
+
+    # Served from the session manager only, no database access
+    session_data = await session_call(session.validate, data.session_token)
+    if not session_data:
+        raise HTTPException(status_code=401, detail="Invalid session token")
+    if data.extend:
+        await session_call(session.extend_session, data.session_token)
+        session_data = await session_call(session.validate, data.session_token) or session_data
+    return {
+        "status": "success",
+        "user_id": session_data["user_id"],
+        "expiry": session_data["expiry"],
+        "flags": list(session_data["flags"]),
+    }
+
 @app.post("/modify-user")
 async def modify_user(data: ModifyUserRequest):
     if data.api_token not in valid_tokens and require_api_token:
         raise HTTPException(status_code=401, detail="Invalid API token")
 
-    if not session.is_session_active(data.session_token):
+    if not await session_call(session.is_session_active, data.session_token):
         raise HTTPException(status_code=401, detail="Invalid session token")
 
-    user_id = session.tokens[data.session_token]["user_id"]
-    user = await repo.get_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    if data.username:
-        if not is_valid_username(data.username):
-            raise HTTPException(status_code=400, detail="Invalid username format")
-        if data.username != user.username:
-            if await repo.get_user_by_username(data.username):
-                raise HTTPException(status_code=400, detail="Username already taken")
-        user.username = data.username
+    if data.username and not is_valid_username(data.username):
+        raise HTTPException(status_code=400, detail="Invalid username format")
+    if data.email and not is_valid_email(data.email):
+        raise HTTPException(status_code=400, detail="Invalid email format")
+    if data.password and not is_valid_password(data.password):
+        raise HTTPException(
+            status_code=400,
+            detail="Password must be at least 7 characters long and include one uppercase letter, one lowercase letter, and one digit"
+        )
 
-    user.username = data.username
-        
-    if data.email:
-        if not is_valid_email(data.email):
-            raise HTTPException(status_code=400, detail="Invalid email format")
-        if data.email != user.email:
-            if await repo.get_user_by_email(data.email):
-                raise HTTPException(status_code=400, detail="Email already registered")
-        user.email = data.email
-    if data.password:
-        if not is_valid_password(data.password):
-            raise HTTPException(
-                status_code=400,
-                detail="Password must be at least 7 characters long and include one uppercase letter, one lowercase letter, and one digit"
-            )
-        user.hashed_password = hash_password(data.password)
-
-    await repo.update(user)
+    user_id = await session_call(session.get_user_id, data.session_token)
+    # Taken emails and usernames are rejected by the unique indexes on commit
+    try:
+        async with repo.unit_of_work() as uow:
+            user = await uow.get_user_by_id(user_id)
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            if data.username:
+                user.username = data.username
+            if data.email:
+                user.email = data.email
+            if data.password:
+                user.hashed_password = await hasher.hash_password(data.password)
+    except DuplicateUserError as e:
+        raise HTTPException(status_code=400, detail=duplicate_detail(e))
     return {"status": "success", "message": "User modified"}
 
-
 if __name__ == "__main__":
     import uvicorn
     host = config["server"].get("host", "127.0.0.1")
     port = config["server"].get("port", 8000)
-    uvicorn.run("main:app", host=host, port=port, reload=False)
\ No newline at end of file
+    workers = config["server"].get("workers", 1)
+    uds = config["server"].get("uds") or None
+    forwarded_allow_ips = config["server"].get("forwarded_allow_ips", "127.0.0.1")
+    uvicorn.run(
+        "main:app", host=host, port=port, uds=uds, workers=workers, reload=False,
+        forwarded_allow_ips=forwarded_allow_ips
+    )
\ No newline at end of file
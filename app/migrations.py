@@ -0,0 +1,63 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from utils import normalize_email
+
+# Stored in PRAGMA user_version
+SCHEMA_VERSION = 1
+
+
+def _columns(conn: Connection, table: str) -> set[str]:
+    return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+
+def _upgrade_to_1(conn: Connection, batch_size: int = 10000):
+    """
+    Adds the email_normalized column and unique indexes on email_normalized and username.
+    """
+    if "email_normalized" not in _columns(conn, "usermodel"):
+        conn.execute(text("ALTER TABLE usermodel ADD COLUMN email_normalized VARCHAR"))
+
+    # Fill the column in rowid batches so large tables are not loaded at once
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT rowid, email FROM usermodel WHERE rowid > :rowid ORDER BY rowid LIMIT :limit"),
+            {"rowid": last_rowid, "limit": batch_size}
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE usermodel SET email_normalized = :email WHERE rowid = :rowid"),
+            [{"rowid": rowid, "email": normalize_email(email)} for rowid, email in rows]
+        )
+        last_rowid = rows[-1][0]
+
+    for column in ("email_normalized", "username"):
+        duplicates = conn.execute(text(
+            f"SELECT {column}, COUNT(*) FROM usermodel GROUP BY {column} HAVING COUNT(*) > 1 LIMIT 10"
+        )).all()
+        if duplicates:
+            values = ", ".join(str(row[0]) for row in duplicates)
+            raise RuntimeError(
+                f"Cannot create unique index on usermodel.{column}, duplicate values: {values}. "
+                "Resolve them manually and restart."
+            )
+        conn.execute(text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS ix_usermodel_{column} ON usermodel ({column})"
+        ))
+
+
+MIGRATIONS = {
+    1: _upgrade_to_1,
+}
+
+
+def upgrade(conn: Connection):
+    """
+    Brings an existing users database up to SCHEMA_VERSION.
+    Runs after SQLModel.metadata.create_all, use with AsyncConnection.run_sync.
+    """
+    version = conn.execute(text("PRAGMA user_version")).scalar()
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        MIGRATIONS[target](conn)
+        conn.execute(text(f"PRAGMA user_version = {target}"))
@@ -2,14 +2,16 @@ from pydantic import BaseModel, EmailStr
 from sqlmodel import SQLModel, Field
 from datetime import datetime, timezone
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
 import uuid
 
 # Database models
 class UserModel(SQLModel, table=True):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
-    username: str
+    username: str = Field(index=True, unique=True)
     email: str
+    # Lower-cased email, used for lookups and uniqueness. Set by UserRepository.
+    email_normalized: Optional[str] = Field(default=None, index=True, unique=True)
     hashed_password: str
     registered_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     last_access: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -27,6 +29,12 @@ class GetUserDataRequest(BaseModel):
     username: Optional[str] = None
     id: Optional[str] = None
 
+class GetUsersDataRequest(BaseModel):
+    api_token: str
+    ids: List[str] = []
+    emails: List[EmailStr] = []
+    usernames: List[str] = []
+
 class LoginRequest(BaseModel):
     api_token: str
     email: EmailStr
@@ -36,6 +44,11 @@ class LogoutRequest(BaseModel):
     api_token: str
     session_token: str
 
+class ValidateSessionRequest(BaseModel):
+    api_token: str
+    session_token: str
+    extend: bool = False
+
 class ModifyUserRequest(BaseModel):
     api_token: str
     session_token: str
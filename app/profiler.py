@@ -0,0 +1,274 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+from metrics import Histogram
+
+
+class RequestProfile:
+    """
+    Phase timings and stack samples of one request.
+    """
+
+    __slots__ = ("start", "task", "sampled", "phases", "open_spans", "samples")
+
+    def __init__(self, task: Optional[asyncio.Task], sampled: bool):
+        self.start = time.perf_counter()
+        self.task = task
+        self.sampled = sampled
+        # phase -> seconds
+        self.phases: dict[str, float] = {}
+        # Names of the spans currently open, innermost last
+        self.open_spans: list[str] = []
+        # Collapsed stack -> number of samples
+        self.samples: Counter = Counter()
+
+
+_current: ContextVar[Optional[RequestProfile]] = ContextVar("request_profile", default=None)
+
+
+class _Span:
+    __slots__ = ("profile", "name", "start")
+
+    def __init__(self, profile: RequestProfile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.profile.open_spans.append(self.name)
+
+    def __exit__(self, *exc):
+        profile = self.profile
+        profile.open_spans.pop()
+        profile.phases[self.name] = profile.phases.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str):
+    """
+    Times a phase of the current request:
+
+        with span("verify_password"):
+            await hasher.verify_password(...)
+
+    Without a profiled request (profiler disabled) this is a no-op.
+    Spans should not be nested, nested time is counted for both phases.
+    """
+    profile = _current.get()
+    if profile is None:
+        return _NO_SPAN
+    return _Span(profile, name)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _task_frames(task: asyncio.Task, loop_frame) -> list:
+    """
+    Frames of a task, outermost first: the chain of awaiting coroutines and,
+    while the task is running, the frames it called on the loop thread.
+    """
+    frames = []
+    coro = task.get_coro()
+    running = False
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        running = getattr(coro, "cr_running", False) or getattr(coro, "gi_running", False)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if running and loop_frame is not None:
+        called = []
+        frame = loop_frame
+        while frame is not None and frame is not frames[-1]:
+            called.append(frame)
+            frame = frame.f_back
+        if frame is not None:
+            frames.extend(reversed(called))
+    return frames
+
+
+class ProfileWriter:
+    """
+    Writes captured requests to `directory` and keeps the newest `max_files`:
+    <name>.folded with the collapsed stacks (flamegraph.pl, speedscope, ...)
+    and <name>.json with the request's phase timings.
+    """
+
+    def __init__(self, directory: str, max_files: int = 100):
+        self.directory = directory
+        self.max_files = max_files
+        self.written = 0
+
+    def write(self, name: str, samples: Counter, info: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        with open(path + ".folded", "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in samples.items())
+        with open(path + ".json", "w") as f:
+            json.dump(info, f, indent=2)
+        self.written += 1
+        self.rotate()
+
+    def rotate(self):
+        # Names start with a timestamp, so sorting them sorts by age
+        names = sorted(name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json"))
+        for name in names[:-self.max_files] if self.max_files else []:
+            for suffix in (".folded", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware that times every HTTP request by phase (see span()) and
+    writes a stack profile of requests slower than `slow_ms` and of a random
+    `sample_rate` share of requests.
+
+    A background thread samples the stacks of requests in progress every
+    `interval_ms`: of sampled requests from the start, of the others once they
+    have run for `sample_after` * `slow_ms` and may become slow. Their stacks
+    before that point are missing from the capture. Samples of requests that are
+    not written are dropped. With `phases`, phase durations are recorded by
+    route and phase.
+    """
+
+    def __init__(
+        self,
+        app,
+        writer: ProfileWriter,
+        slow_ms: float = 250,
+        sample_rate: float = 0.0,
+        interval_ms: float = 10,
+        sample_after: float = 0.5,
+        phases: Optional[Histogram] = None,
+        exclude: tuple = (),
+    ):
+        self.app = app
+        self.writer = writer
+        self.slow = slow_ms / 1000
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+        self.sample_after = self.slow * sample_after
+        self.phases = phases
+        self.exclude = exclude
+        # Requests in progress, read by the sampler thread: sampled ones, and the
+        # others in the order they started
+        self.sampled: dict[int, RequestProfile] = {}
+        self.active: dict[int, RequestProfile] = {}
+        self.sampler: Optional[threading.Thread] = None
+        self.loop_thread: Optional[int] = None
+        self.captured = 0
+
+    def _start_sampler(self):
+        self.loop_thread = threading.get_ident()
+        self.sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+        self.sampler.start()
+
+    def _due_profiles(self) -> list[RequestProfile]:
+        profiles = list(self.sampled.values())
+        started_before = time.perf_counter() - self.sample_after
+        try:
+            # Oldest first, so only the requests that may become slow are visited
+            for profile in self.active.values():
+                if profile.start > started_before:
+                    break
+                profiles.append(profile)
+        except RuntimeError:
+            # A request started or finished meanwhile, the rest waits for the next tick
+            pass
+        return profiles
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            profiles = self._due_profiles()
+            if not profiles:
+                continue
+            loop_frame = sys._current_frames().get(self.loop_thread)
+            for profile in profiles:
+                if profile.task is None:
+                    continue
+                try:
+                    frames = _task_frames(profile.task, loop_frame)
+                except (AttributeError, ValueError):
+                    # The task moved on while it was being walked
+                    continue
+                stack = ";".join(profile.open_spans + [_frame_name(frame) for frame in frames])
+                profile.samples[stack or "idle"] += 1
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+        if self.sampler is None:
+            self._start_sampler()
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profile = RequestProfile(asyncio.current_task(), random.random() < self.sample_rate)
+        token = _current.set(profile)
+        in_progress = self.sampled if profile.sampled else self.active
+        in_progress[id(profile)] = profile
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            del in_progress[id(profile)]
+            _current.reset(token)
+            duration = time.perf_counter() - profile.start
+            route = getattr(scope.get("route"), "path", "unmatched")
+            if self.phases:
+                for phase, seconds in profile.phases.items():
+                    self.phases.observe(seconds, route, phase)
+            if duration >= self.slow or profile.sampled:
+                await self._capture(profile, scope["method"], route, status, duration)
+
+    async def _capture(self, profile: RequestProfile, method: str, route: str, status: int, duration: float):
+        other = duration - sum(profile.phases.values())
+        info = {
+            "method": method,
+            "route": route,
+            "status": status,
+            "duration_ms": round(duration * 1000, 3),
+            "reason": "slow" if duration >= self.slow else "sampled",
+            "phases_ms": {
+                **{phase: round(seconds * 1000, 3) for phase, seconds in profile.phases.items()},
+                "other": round(max(other, 0.0) * 1000, 3),
+            },
+            "samples": sum(profile.samples.values()),
+            "interval_ms": self.interval * 1000,
+        }
+        timestamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        name = f"{timestamp}-{self.captured:06d}-{route.strip('/').replace('/', '_') or 'root'}-{int(duration * 1000)}ms"
+        self.captured += 1
+        await asyncio.to_thread(self.writer.write, name, profile.samples, info)
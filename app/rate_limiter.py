@@ -1,4 +1,6 @@
-from collections import defaultdict, deque
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict, deque
 from time import time
 from typing import Deque, Dict
 
@@ -41,3 +43,250 @@ class RateLimiter:
         If limited, it returns False.
         """
         return not self.is_limited(identifier)
+
+    def tracked_keys(self) -> int:
+        return len(self.attempts)
+
+    def close(self):
+        pass
+
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding-window counter limiter with fixed memory per identifier.
+
+    Instead of one timestamp per attempt, only the attempt counts of the current
+    and the previous fixed window are kept. The previous window is weighted by how
+    much of it still overlaps the sliding window.
+    Identifiers that were idle for two windows are evicted, and `max_keys` optionally
+    caps the number of tracked identifiers (least recently used ones are dropped first).
+    """
+
+    def __init__(self, max_attempts: int, window_seconds: int, max_keys: int = 0):
+        self.max_attempts = max_attempts
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        # identifier -> [window index, previous count, current count], least recently used first
+        self.attempts: OrderedDict[str, list] = OrderedDict()
+        self._swept_window = 0
+
+    def _evict_idle(self, window: int):
+        # Entries are ordered by last use, so idle ones are at the front.
+        # They can only become idle when a new window starts.
+        if window == self._swept_window:
+            return
+        self._swept_window = window
+        while self.attempts:
+            identifier, entry = next(iter(self.attempts.items()))
+            if entry[0] >= window - 1:
+                break
+            del self.attempts[identifier]
+
+    def is_limited(self, identifier: str) -> bool:
+        """
+        Checks if the identifier has exceeded the maximum number of attempts within the time window.
+        If the limit is not exceeded, the attempt is recorded and False is returned.
+        """
+        now = time()
+        window = int(now // self.window_seconds)
+        self._evict_idle(window)
+
+        entry = self.attempts.get(identifier)
+        if entry is None:
+            if self.max_attempts <= 0:
+                return True
+            self.attempts[identifier] = [window, 0, 1]
+            if self.max_keys and len(self.attempts) > self.max_keys:
+                self.attempts.popitem(last=False)
+            return False
+
+        self.attempts.move_to_end(identifier)
+        if entry[0] != window:
+            entry[1] = entry[2] if entry[0] == window - 1 else 0
+            entry[2] = 0
+            entry[0] = window
+
+        elapsed = now / self.window_seconds - window
+        if entry[1] * (1 - elapsed) + entry[2] >= self.max_attempts:
+            return True
+
+        entry[2] += 1
+        return False
+
+    def reset(self, identifier: str):
+        """
+        Resets the attempts for the given identifier.
+        """
+        self.attempts.pop(identifier, None)
+
+    def allow_attempt(self, identifier: str) -> bool:
+        """
+        Allows an attempt if the identifier is not limited.
+        If allowed, it records the attempt and returns True.
+        If limited, it returns False.
+        """
+        return not self.is_limited(identifier)
+
+    def tracked_keys(self) -> int:
+        return len(self.attempts)
+
+    def close(self):
+        pass
+
+
+class SqliteRateLimiter:
+    """
+    Sliding-window counter limiter (see SlidingWindowRateLimiter) whose counters
+    live in a SQLite table in WAL mode, so all worker processes on the host share
+    one limit instead of each allowing `max_attempts`.
+
+    Reading, checking and incrementing a counter happen in one write transaction
+    (BEGIN IMMEDIATE), so two workers can not both take the last attempt.
+    Several limiters can share a database file; `name` separates their counters.
+
+    Waiting for the write lock can take up to `busy_timeout_ms`, so async callers
+    should run is_limited()/allow_attempt() in a thread (asyncio.to_thread). Calls
+    from several threads are serialized on the one connection.
+    """
+
+    def __init__(self, max_attempts: int, window_seconds: int, path: str, name: str = "email", busy_timeout_ms: int = 5000):
+        self.max_attempts = max_attempts
+        self.window_seconds = window_seconds
+        self.name = name
+        self._swept_window = 0
+        self.lock = threading.Lock()
+        # Last counted number of identifiers, reported while the connection is busy
+        self.keys = 0
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            " name TEXT NOT NULL,"
+            " identifier TEXT NOT NULL,"
+            " window INTEGER NOT NULL,"
+            " previous INTEGER NOT NULL,"
+            " current INTEGER NOT NULL,"
+            " PRIMARY KEY (name, identifier)"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_rate_limits_window ON rate_limits (name, window)")
+
+    def _evict_idle(self, window: int):
+        # Counters idle for two windows no longer matter; checked once per window and process
+        if window == self._swept_window:
+            return
+        self._swept_window = window
+        self.conn.execute("DELETE FROM rate_limits WHERE name = ? AND window < ?", (self.name, window - 1))
+
+    def is_limited(self, identifier: str) -> bool:
+        """
+        Checks if the identifier has exceeded the maximum number of attempts within the time window.
+        If the limit is not exceeded, the attempt is recorded and False is returned.
+        """
+        with self.lock:
+            return self._is_limited(identifier)
+
+    def _is_limited(self, identifier: str) -> bool:
+        now = time()
+        window = int(now // self.window_seconds)
+        self._evict_idle(window)
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT window, previous, current FROM rate_limits WHERE name = ? AND identifier = ?",
+                (self.name, identifier)
+            ).fetchone()
+            previous, current = 0, 0
+            if row is not None:
+                if row[0] == window:
+                    previous, current = row[1], row[2]
+                elif row[0] == window - 1:
+                    previous = row[2]
+
+            elapsed = now / self.window_seconds - window
+            limited = previous * (1 - elapsed) + current >= self.max_attempts
+            if not limited:
+                current += 1
+            if not limited or row is None or row[0] != window:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO rate_limits (name, identifier, window, previous, current)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (self.name, identifier, window, previous, current)
+                )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return limited
+
+    def reset(self, identifier: str):
+        """
+        Resets the attempts for the given identifier.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM rate_limits WHERE name = ? AND identifier = ?", (self.name, identifier))
+
+    def allow_attempt(self, identifier: str) -> bool:
+        """
+        Allows an attempt if the identifier is not limited.
+        If allowed, it records the attempt and returns True.
+        If limited, it returns False.
+        """
+        return not self.is_limited(identifier)
+
+    def tracked_keys(self) -> int:
+        # Called from metrics collection on the event loop: never wait for a running check
+        if self.lock.acquire(blocking=False):
+            try:
+                self.keys = self.conn.execute(
+                    "SELECT COUNT(*) FROM rate_limits WHERE name = ?", (self.name,)
+                ).fetchone()[0]
+            finally:
+                self.lock.release()
+        return self.keys
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_rate_limiter(conf: dict, name: str = "email"):
+    """
+    Builds a limiter configured in a [ratelimit] config section.
+    `name` "email" uses max_attempts/window_seconds, "ip" uses ip_max_attempts/ip_window_seconds.
+    """
+    if name == "ip":
+        max_attempts = conf.get("ip_max_attempts", 0)
+        window_seconds = conf.get("ip_window_seconds", 60)
+    else:
+        max_attempts = conf["max_attempts"]
+        window_seconds = conf["window_seconds"]
+
+    backend = conf.get("backend", "memory")
+    if backend == "sqlite":
+        return SqliteRateLimiter(
+            max_attempts=max_attempts,
+            window_seconds=window_seconds,
+            path=conf.get("sqlite_path", "./ratelimit.db"),
+            name=name,
+            busy_timeout_ms=conf.get("sqlite_busy_timeout_ms", 5000)
+        )
+    if backend != "memory":
+        raise ValueError(f"Unknown rate limit backend: {backend}")
+
+    algorithm = conf.get("algorithm", "deque")
+    if algorithm == "deque":
+        return RateLimiter(
+            max_attempts=max_attempts,
+            window_seconds=window_seconds
+        )
+    if algorithm == "sliding_window":
+        return SlidingWindowRateLimiter(
+            max_attempts=max_attempts,
+            window_seconds=window_seconds,
+            max_keys=conf.get("max_keys", 0)
+        )
+    raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
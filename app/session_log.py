@@ -0,0 +1,211 @@
+import os
+import struct
+from typing import Iterable, Optional
+
+# Every record has the same layout, so a whole file is decoded with one
+# struct.iter_unpack call: op, token (16 bytes), user_id (16 bytes), value
+RECORD = struct.Struct("<B16s16sd")
+VERSION = 1
+
+OP_HEADER = 0       # value: format version
+OP_CREATE = 1       # token, user_id, value: expiry
+OP_DELETE = 2       # token
+OP_EXPIRY = 3       # token, value: expiry
+OP_FLAG_NAME = 4    # token + user_id: flag name (UTF-8, max. 32 bytes), value: flag id
+OP_FLAG_ADD = 5     # token, value: flag id
+OP_FLAG_REMOVE = 6  # token, value: flag id
+
+EMPTY_ID = bytes(16)
+MAX_FLAG_NAME = 32
+
+
+def pack_id(value: str) -> Optional[bytes]:
+    """
+    Packs a lower-case UUID string into 16 bytes, None for anything else
+    (e.g. signed tokens, which can not be persisted and need not be).
+    """
+    if len(value) != 36 or value != value.lower():
+        return None
+    try:
+        return bytes.fromhex(value.replace("-", ""))
+    except ValueError:
+        return None
+
+
+def unpack_id(value: bytes) -> str:
+    h = value.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+class SessionLog:
+    """
+    Append-only binary log of session changes plus a compacted snapshot.
+
+    `path` holds the snapshot, `path`.log the changes since. A snapshot is
+    taken in two steps: rotate() moves the log aside to `path`.log.prev and
+    starts a new one, write_snapshot() then replaces the snapshot atomically and
+    removes the old log. Only write_snapshot() touches the disk at length, it
+    may run in another thread while changes are appended to the new log.
+    Replay reads snapshot, old log and log, so a crash between the steps loses
+    nothing. Appends are buffered and written on flush(), so a crash loses the
+    changes since the last flush. A torn record at the end of a file is ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.log_path = path + ".log"
+        self.prev_path = path + ".log.prev"
+        self.file = None
+        # Records appended since the last snapshot
+        self.records = 0
+        self.flag_ids: dict[str, int] = {}
+
+    def _read(self, path: str) -> memoryview:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        usable = len(data) - len(data) % RECORD.size
+        return memoryview(data)[:usable]
+
+    def replay(self) -> tuple[dict[bytes, tuple[bytes, float]], dict[bytes, list[str]]]:
+        """
+        Replays snapshot and log. Returns {token: (user_id, expiry)} with packed
+        ids, including expired sessions, and {token: flag names} of flagged sessions.
+        """
+        sessions: dict[bytes, tuple[bytes, float]] = {}
+        flags: dict[bytes, list[str]] = {}
+        names: dict[int, str] = {}
+        self.records = 0
+        for path in (self.path, self.prev_path, self.log_path):
+            data = self._read(path)
+            if path != self.path:
+                self.records += len(data) // RECORD.size
+            for op, token, user_id, value in RECORD.iter_unpack(data):
+                # Creates make up almost all records, check them first
+                if op == OP_CREATE:
+                    sessions[token] = (user_id, value)
+                    if flags:
+                        flags.pop(token, None)
+                elif op == OP_EXPIRY:
+                    session = sessions.get(token)
+                    if session is not None:
+                        sessions[token] = (session[0], value)
+                elif op == OP_DELETE:
+                    sessions.pop(token, None)
+                    flags.pop(token, None)
+                elif op == OP_FLAG_ADD or op == OP_FLAG_REMOVE:
+                    if token not in sessions:
+                        continue
+                    flag = names[int(value)]
+                    token_flags = flags.setdefault(token, [])
+                    if op == OP_FLAG_ADD and flag not in token_flags:
+                        token_flags.append(flag)
+                    elif op == OP_FLAG_REMOVE and flag in token_flags:
+                        token_flags.remove(flag)
+                elif op == OP_FLAG_NAME:
+                    names[int(value)] = (token + user_id).rstrip(b"\0").decode()
+                elif op == OP_HEADER and int(value) != VERSION:
+                    raise ValueError(f"Unsupported session log version {int(value)} in {path}")
+        self.flag_ids = {name: flag_id for flag_id, name in names.items()}
+        return sessions, flags
+
+    def _header(self) -> bytes:
+        return RECORD.pack(OP_HEADER, EMPTY_ID, EMPTY_ID, VERSION)
+
+    def _flag_name(self, name: str, flag_id: int) -> bytes:
+        encoded = name.encode().ljust(MAX_FLAG_NAME, b"\0")
+        return RECORD.pack(OP_FLAG_NAME, encoded[:16], encoded[16:], flag_id)
+
+    def open(self):
+        if self.file is None:
+            size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+            self.file = open(self.log_path, "ab")
+            if size % RECORD.size:
+                # Drop a torn record, so new records stay aligned
+                self.file.truncate(size - size % RECORD.size)
+            if size < RECORD.size:
+                self.file.write(self._header())
+
+    def append(self, op: int, token: bytes = EMPTY_ID, user_id: bytes = EMPTY_ID, value: float = 0.0):
+        if self.file is None:
+            self.open()
+        self.file.write(RECORD.pack(op, token, user_id, value))
+        self.records += 1
+
+    def flag_id(self, name: str) -> Optional[int]:
+        """Id of a flag name, defined in the log on first use. None if the name is too long."""
+        flag_id = self.flag_ids.get(name)
+        if flag_id is None:
+            if len(name.encode()) > MAX_FLAG_NAME:
+                return None
+            flag_id = self.flag_ids[name] = len(self.flag_ids)
+            if self.file is None:
+                self.open()
+            self.file.write(self._flag_name(name, flag_id))
+            self.records += 1
+        return flag_id
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def rotate(self) -> dict[str, int]:
+        """
+        Moves the log aside and starts a new one. Returns the flag ids to pass to
+        write_snapshot(), which must follow before the next rotate().
+        """
+        self.close()
+        if os.path.exists(self.prev_path):
+            # The last snapshot was not written: keep collecting in the old log
+            data = self._read(self.log_path)[RECORD.size:]
+            with open(self.prev_path, "r+b") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.truncate(size - size % RECORD.size)
+                f.seek(0, os.SEEK_END)
+                f.write(data)
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+        elif os.path.exists(self.log_path):
+            os.replace(self.log_path, self.prev_path)
+        self.file = open(self.log_path, "wb")
+        self.file.write(self._header())
+        self.records = 0
+        return dict(self.flag_ids)
+
+    def write_snapshot(self, sessions: Iterable[tuple[bytes, bytes, float, list]], flag_ids: dict[str, int]):
+        """
+        Writes (token, user_id, expiry, flags) records, the state at the last
+        rotate(), as the new snapshot and removes the old log. Does not use the
+        open log, so it can run in a thread.
+        """
+        parts = [self._header()]
+        parts.extend(self._flag_name(name, flag_id) for name, flag_id in flag_ids.items())
+        flagged = []
+        pack = RECORD.pack
+        for token, user_id, expiry, flags in sessions:
+            parts.append(pack(OP_CREATE, token, user_id, expiry))
+            if flags:
+                flagged.append((token, flags))
+        for token, flags in flagged:
+            for flag in flags:
+                if flag in flag_ids:
+                    parts.append(pack(OP_FLAG_ADD, token, EMPTY_ID, flag_ids[flag]))
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(parts))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Everything in the old log is part of the snapshot now
+        try:
+            os.remove(self.prev_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -1,74 +1,213 @@
+import asyncio
+import threading
 import time
-from collections import defaultdict
+import uuid
+from collections.abc import Mapping
+from typing import Optional
+from session_store import SessionStore, MemorySessionStore
+from signed_tokens import TokenSigner
+from profiler import span
 
 class SessionManager:
-    def __init__(self, timeout: int = 3600):
-        # token -> session_data (dict)
-        self.tokens: dict[str, dict] = {}
+    def __init__(self, timeout: int = 3600, store: Optional[SessionStore] = None, signer: Optional[TokenSigner] = None):
+        # Sessions live in the store; the in-process dicts are the default
+        self.store = store if store is not None else MemorySessionStore()
+        self.timeout = timeout
+        self.evicted_sessions = 0
 
-        # user_id -> set of tokens
-        self.tokens_by_id: dict[str, set[str]] = defaultdict(set)
+        # With a signer, tokens are signed and validated without a store lookup.
+        # Revoked tokens are kept in a denylist until they expire:
+        # token -> expiry
+        self.revoked_tokens: dict[str, float] = {}
+        # user_id -> time of close_sessions_for_id, tokens issued before are revoked
+        self.revoked_users: dict[str, float] = {}
+        # With a blocking store, callers run the methods in threads (see SessionStore.blocking);
+        # revocations must not get lost while trim_denylist() rebuilds the dicts
+        self.denylist_lock = threading.Lock()
+        self.signer = signer
 
-        self.timeout = timeout
+    @property
+    def tokens(self) -> Mapping[str, dict]:
+        """Read-only token -> session_data view, only available for the in-memory store."""
+        return self.store.tokens
+
+    @property
+    def tokens_by_id(self) -> Mapping[str, set[str]]:
+        """Read-only user_id -> set of tokens view, only available for the in-memory store."""
+        return self.store.tokens_by_id
 
     # --- Session Management ---
-    
+
     def create_session(self, token: str, user_id: str):
         now = time.time()
-        self.tokens[token] = {
-            "user_id": user_id,
-            "flags": [],
-            "expiry": now + self.timeout
-        }
-        self.tokens_by_id[user_id].add(token)
+        self.store.create(token, user_id, now + self.timeout)
+
+    def issue_session(self, user_id: str) -> str:
+        """
+        Creates a session with a new token and returns the token.
+        """
+        with span("session"):
+            if self.signer:
+                now = time.time()
+                token = self.signer.issue(user_id, now + self.timeout, issued_at=now)
+            else:
+                token = str(uuid.uuid4())
+            self.create_session(token, user_id)
+        return token
 
     def close_session_for_token(self, token: str):
-        session = self.tokens.pop(token, None)
-        if session:
-            user_id = session["user_id"]
-            self.tokens_by_id[user_id].discard(token)
-            if not self.tokens_by_id[user_id]:
-                del self.tokens_by_id[user_id]
+        with span("session"):
+            self.store.delete(token)
+            if self.signer:
+                claims = self.signer.verify(token)
+                if claims:
+                    with self.denylist_lock:
+                        self.revoked_tokens[token] = claims["expiry"]
 
     def close_sessions_for_id(self, user_id: str):
-        tokens = self.tokens_by_id.pop(user_id, set())
-        for token in tokens:
-            self.tokens.pop(token, None)
+        self.store.delete_user(user_id)
+        if self.signer:
+            with self.denylist_lock:
+                self.revoked_users[user_id] = time.time()
 
     def extend_session(self, token: str):
-        if token in self.tokens:
-            self.tokens[token]["expiry"] = time.time() + self.timeout
+        # Signed tokens carry their expiry and can not be extended
+        now = time.time()
+        with span("session"):
+            self.store.set_expiry(token, now + self.timeout, now)
+
+    def _verify_signed(self, token: str) -> Optional[dict]:
+        claims = self.signer.verify(token)
+        if claims is None or claims["expiry"] <= time.time() or token in self.revoked_tokens:
+            return None
+        revoked_at = self.revoked_users.get(claims["user_id"])
+        if revoked_at is not None and claims["issued_at"] <= revoked_at:
+            return None
+        return claims
+
+    def validate(self, token: str) -> Optional[dict]:
+        """
+        Returns {"user_id", "expiry", "flags"} of an active session, otherwise None.
+        """
+        with span("session"):
+            if self.signer:
+                # No store lookup: the flags are those the token was issued with,
+                # flags changed later are read by session_has_flag()/get_flags_*()
+                claims = self._verify_signed(token)
+                if claims is None:
+                    return None
+                return {"user_id": claims["user_id"], "expiry": claims["expiry"], "flags": claims["flags"]}
+            record = self.store.get_record(token)
+        if record is None or record.expiry <= time.time():
+            return None
+        return record.as_dict()
+
+    def _active_record(self, token: str):
+        # Like validate(), without building a dict. No span: with the memory store this is
+        # a dict lookup, cheaper than the span itself
+        record = self.store.get_record(token)
+        if record is None or record.expiry <= time.time():
+            return None
+        return record
 
     def is_session_active(self, token: str) -> bool:
-        return token in self.tokens and self.tokens[token]["expiry"] > time.time()
+        if self.signer:
+            return self.validate(token) is not None
+        return self._active_record(token) is not None
+
+    def get_user_id(self, token: str) -> Optional[str]:
+        if self.signer:
+            session = self.validate(token)
+            return session["user_id"] if session else None
+        record = self._active_record(token)
+        return record.user_id if record else None
+
+    def is_user_active(self, user_id: str) -> bool:
+        return bool(self.store.active_users((user_id,), time.time()))
+
+    def active_users(self, user_ids) -> set[str]:
+        """Returns the subset of `user_ids` that has at least one active session."""
+        return self.store.active_users(user_ids, time.time())
+
+    # --- Expiry ---
+
+    def restore(self) -> int:
+        """
+        Loads the sessions persisted by the store (if any) that have not expired yet.
+        """
+        return self.store.load(time.time())
+
+    @property
+    def live_sessions(self) -> int:
+        return self.store.count()
+
+    def evict_expired(self, now: float = None, limit: int = 0) -> int:
+        """
+        Removes the sessions that expired at or before `now`, with `limit` only
+        about that many (see SessionStore.evict_expired).
+        Returns the number of evicted sessions.
+        """
+        if now is None:
+            now = time.time()
+        evicted = self.store.evict_expired(now, limit)
+        self.evicted_sessions += evicted
+        if (self.revoked_tokens or self.revoked_users) and not (limit and self.store.has_expired(now)):
+            self.trim_denylist(now)
+        return evicted
+
+    def trim_denylist(self, now: float):
+        """
+        Drops revocations of tokens that have expired anyway.
+        """
+        cutoff = now - self.timeout
+        with self.denylist_lock:
+            self.revoked_tokens = {token: expiry for token, expiry in self.revoked_tokens.items() if expiry > now}
+            self.revoked_users = {user_id: at for user_id, at in self.revoked_users.items() if at > cutoff}
+
+    async def run_expiry_loop(self, interval: float = 5.0, batch_size: int = 10000):
+        """
+        Evicts expired sessions every `interval` seconds until cancelled.
+        A burst of expiries (e.g. after a login storm) is evicted `batch_size`
+        at a time, other tasks run in between. With a blocking store the
+        sweep runs in a thread.
+        """
+        while True:
+            now = time.time()
+            if self.store.blocking:
+                await asyncio.to_thread(self.evict_expired, now)
+            else:
+                self.evict_expired(now, batch_size)
+                while self.store.has_expired(now):
+                    await asyncio.sleep(0)
+                    self.evict_expired(now, batch_size)
+            await asyncio.sleep(interval)
 
     # --- Flag Management ---
-    
+
     def session_has_flag(self, token: str, flag: str) -> bool:
-        return token in self.tokens and flag in self.tokens.get(token, {}).get("flags", [])
+        return self.store.has_flag(token, flag)
 
     def get_flags_by_token(self, token: str) -> list:
-        return self.tokens.get(token, {}).get("flags", [])
+        session = self.store.get(token)
+        return session["flags"] if session else []
 
     def get_flags_by_id(self, user_id: str) -> dict:
         """Returns a dict of {token: flags} for all active sessions of the user."""
         result = {}
-        for token in self.tokens_by_id.get(user_id, set()):
+        for token in self.store.tokens_for_user(user_id):
             result[token] = self.get_flags_by_token(token)
         return result
 
     def add_flag_by_token(self, token: str, flag: str):
-        if token in self.tokens and flag not in self.tokens[token]["flags"]:
-            self.tokens[token]["flags"].append(flag)
+        self.store.add_flag(token, flag)
 
     def remove_flag_by_token(self, token: str, flag: str):
-        if token in self.tokens and flag in self.tokens[token]["flags"]:
-            self.tokens[token]["flags"].remove(flag)
+        self.store.remove_flag(token, flag)
 
     def add_flag_by_id(self, user_id: str, flag: str):
-        for token in self.tokens_by_id.get(user_id, set()):
+        for token in self.store.tokens_for_user(user_id):
             self.add_flag_by_token(token, flag)
 
     def remove_flag_by_id(self, user_id: str, flag: str):
-        for token in self.tokens_by_id.get(user_id, set()):
+        for token in self.store.tokens_for_user(user_id):
             self.remove_flag_by_token(token, flag)
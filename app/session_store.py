@@ -0,0 +1,650 @@
+import gc
+import json
+import logging
+import sqlite3
+import sys
+import threading
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from operator import itemgetter
+from typing import Iterator, Optional
+from session_log import (
+    SessionLog, pack_id, unpack_id,
+    OP_CREATE, OP_DELETE, OP_EXPIRY, OP_FLAG_ADD, OP_FLAG_REMOVE,
+)
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class SessionStore:
+    """
+    Storage backend interface for SessionManager.
+    A session is a dict with "user_id", "flags" (list) and "expiry" (unix time).
+    """
+
+    # True if calls can wait on locks held by other processes: async callers then
+    # run them in a thread (asyncio.to_thread) instead of on the event loop
+    blocking = False
+
+    def create(self, token: str, user_id: str, expiry: float):
+        raise NotImplementedError
+
+    def get(self, token: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def get_record(self, token: str) -> Optional["SessionRecord"]:
+        """
+        The session as a SessionRecord, for the hot paths that only read user_id
+        and expiry. Stores that keep records return their own: do not modify it.
+        """
+        session = self.get(token)
+        if session is None:
+            return None
+        return SessionRecord(session["user_id"], session["expiry"], frozenset(session["flags"]))
+
+    def delete(self, token: str) -> bool:
+        raise NotImplementedError
+
+    def delete_user(self, user_id: str) -> int:
+        raise NotImplementedError
+
+    def tokens_for_user(self, user_id: str) -> set[str]:
+        raise NotImplementedError
+
+    def set_expiry(self, token: str, expiry: float, now: float):
+        """Sets a new expiry, only for a session that is still valid at `now`."""
+        raise NotImplementedError
+
+    def active_users(self, user_ids, now: float) -> set[str]:
+        """Returns the subset of `user_ids` that has at least one session valid at `now`."""
+        active = set()
+        for user_id in user_ids:
+            for token in list(self.tokens_for_user(user_id)):
+                session = self.get(token)
+                if session is not None and session["expiry"] > now:
+                    active.add(user_id)
+                    break
+        return active
+
+    def has_flag(self, token: str, flag: str) -> bool:
+        session = self.get(token)
+        return session is not None and flag in session["flags"]
+
+    def add_flag(self, token: str, flag: str):
+        raise NotImplementedError
+
+    def remove_flag(self, token: str, flag: str):
+        raise NotImplementedError
+
+    def evict_expired(self, now: float, limit: int = 0) -> int:
+        """
+        Removes sessions that expired at or before `now` and returns their number.
+        With `limit`, stops after about that many; has_expired() tells if some are left.
+        """
+        raise NotImplementedError
+
+    def has_expired(self, now: float) -> bool:
+        """True if sessions that expired at or before `now` may be left to evict."""
+        return False
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def load(self, now: float) -> int:
+        """Restores persisted sessions that are still valid at `now` and returns their number."""
+        return 0
+
+    def close(self):
+        pass
+
+
+def _key(token: str):
+    """
+    UUID tokens are kept as 16 bytes, other tokens (e.g. signed ones) as they are.
+    Like UUIDs, the 16-byte form does not depend on the case of the hex digits.
+    """
+    if len(token) == 36 and token[8] == token[13] == token[18] == token[23] == "-":
+        try:
+            return bytes.fromhex(token.replace("-", ""))
+        except ValueError:
+            pass
+    return token
+
+
+def _token(key) -> str:
+    return unpack_id(key) if type(key) is bytes else key
+
+
+NO_FLAGS = frozenset()
+
+
+class SessionRecord:
+    __slots__ = ("user_id", "expiry", "flags")
+
+    def __init__(self, user_id: str, expiry: float, flags: frozenset = NO_FLAGS):
+        self.user_id = user_id
+        self.expiry = expiry
+        self.flags = flags
+
+    def as_dict(self) -> dict:
+        return {"user_id": self.user_id, "flags": list(self.flags) if self.flags else [], "expiry": self.expiry}
+
+
+class TokensView(Mapping):
+    """Read-only token -> session dict view of a MemorySessionStore."""
+
+    def __init__(self, store: "MemorySessionStore"):
+        self.store = store
+
+    def __getitem__(self, token: str) -> dict:
+        session = self.store.get(token)
+        if session is None:
+            raise KeyError(token)
+        return session
+
+    def __contains__(self, token) -> bool:
+        return isinstance(token, str) and _key(token) in self.store.records
+
+    def __iter__(self) -> Iterator[str]:
+        return map(_token, list(self.store.records))
+
+    def __len__(self) -> int:
+        return len(self.store.records)
+
+
+class TokensByIdView(Mapping):
+    """Read-only user_id -> set of tokens view of a MemorySessionStore."""
+
+    def __init__(self, store: "MemorySessionStore"):
+        self.store = store
+
+    def __getitem__(self, user_id: str) -> set[str]:
+        if user_id not in self.store.keys_by_user:
+            raise KeyError(user_id)
+        return self.store.tokens_for_user(user_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.store.keys_by_user))
+
+    def __len__(self) -> int:
+        return len(self.store.keys_by_user)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Keeps the sessions in dicts of the current process (default).
+
+    Sessions are SessionRecord objects keyed by the 16-byte form of the token,
+    with interned user ids and flags as a frozenset: about 325 bytes per session,
+    against about 377 plus the token string for a dict per session. `tokens` and
+    `tokens_by_id` give the old string-keyed view for callers outside the store.
+    get() builds a dict per call; get_record() returns the record itself.
+    """
+
+    def __init__(self):
+        # key -> SessionRecord, see _key()
+        self.records: dict = {}
+
+        # user_id -> key, or a set of keys once the user has several sessions.
+        # Most users have one session, and a set would cost ~200 bytes.
+        self.keys_by_user: dict[str, object] = {}
+
+        # (expiry, key) in expiry order. Since every session uses the same timeout,
+        # appending keeps the queue sorted. Extending a session does not add an entry:
+        # when its old entry reaches the front, it is queued again at the new expiry,
+        # so one session has one entry however often it is extended. Those entries
+        # are appended out of order, such a session is evicted at most one timeout late.
+        # Closed sessions leave stale entries behind that are skipped.
+        self.expiry_queue: deque[tuple[float, object]] = deque()
+
+    @property
+    def tokens(self) -> TokensView:
+        return TokensView(self)
+
+    @property
+    def tokens_by_id(self) -> TokensByIdView:
+        return TokensByIdView(self)
+
+    def _user_keys(self, user_id: str):
+        keys = self.keys_by_user.get(user_id)
+        if keys is None:
+            return ()
+        return keys if type(keys) is set else (keys,)
+
+    def _index(self, key, user_id: str):
+        keys = self.keys_by_user.get(user_id)
+        if keys is None:
+            self.keys_by_user[user_id] = key
+        elif type(keys) is set:
+            keys.add(key)
+        elif keys != key:
+            self.keys_by_user[user_id] = {keys, key}
+
+    def _unindex(self, key, user_id: str):
+        keys = self.keys_by_user.get(user_id)
+        if type(keys) is set:
+            keys.discard(key)
+            if len(keys) == 1:
+                self.keys_by_user[user_id] = next(iter(keys))
+        elif keys == key:
+            del self.keys_by_user[user_id]
+
+    def create(self, token: str, user_id: str, expiry: float):
+        self._create(_key(token), sys.intern(user_id), expiry)
+
+    def _create(self, key, user_id: str, expiry: float):
+        old = self.records.get(key)
+        if old is not None:
+            self._unindex(key, old.user_id)
+        self.records[key] = SessionRecord(user_id, expiry)
+        self._index(key, user_id)
+        self.expiry_queue.append((expiry, key))
+
+    def get(self, token: str) -> Optional[dict]:
+        record = self.records.get(_key(token))
+        return record.as_dict() if record is not None else None
+
+    def get_record(self, token: str) -> Optional[SessionRecord]:
+        return self.records.get(_key(token))
+
+    def has_flag(self, token: str, flag: str) -> bool:
+        record = self.records.get(_key(token))
+        return record is not None and flag in record.flags
+
+    def delete(self, token: str) -> bool:
+        return self._delete(_key(token))
+
+    def _delete(self, key) -> bool:
+        record = self.records.pop(key, None)
+        if record is None:
+            return False
+        self._unindex(key, record.user_id)
+        return True
+
+    def delete_user(self, user_id: str) -> int:
+        keys = list(self._user_keys(user_id))
+        for key in keys:
+            self._delete(key)
+        return len(keys)
+
+    def tokens_for_user(self, user_id: str) -> set[str]:
+        return {_token(key) for key in self._user_keys(user_id)}
+
+    def active_users(self, user_ids, now: float) -> set[str]:
+        records = self.records
+        active = set()
+        for user_id in user_ids:
+            for key in self._user_keys(user_id):
+                if records[key].expiry > now:
+                    active.add(user_id)
+                    break
+        return active
+
+    def set_expiry(self, token: str, expiry: float, now: float):
+        self._set_expiry(_key(token), expiry, now)
+
+    def _set_expiry(self, key, expiry: float, now: float) -> bool:
+        record = self.records.get(key)
+        # Expired sessions wait for the sweep and must not come back
+        if record is None or record.expiry <= now:
+            return False
+        # Queued again by evict_expired() once the old entry is due
+        record.expiry = expiry
+        return True
+
+    def add_flag(self, token: str, flag: str):
+        self._add_flag(_key(token), flag)
+
+    def _add_flag(self, key, flag: str) -> bool:
+        record = self.records.get(key)
+        if record is None or flag in record.flags:
+            return False
+        record.flags = record.flags | {flag}
+        return True
+
+    def remove_flag(self, token: str, flag: str):
+        self._remove_flag(_key(token), flag)
+
+    def _remove_flag(self, key, flag: str) -> bool:
+        record = self.records.get(key)
+        if record is None or flag not in record.flags:
+            return False
+        record.flags = (record.flags - {flag}) or NO_FLAGS
+        return True
+
+    def evict_expired(self, now: float, limit: int = 0) -> int:
+        # Each queue entry is popped once per expiry of its session, so the cost is
+        # amortized O(1) per session and extension. `limit` counts popped entries.
+        queue = self.expiry_queue
+        records = self.records
+        evicted = 0
+        remaining = limit or -1
+        while queue and queue[0][0] <= now and remaining:
+            remaining -= 1
+            key = queue.popleft()[1]
+            record = records.get(key)
+            # Skip stale entries of closed sessions
+            if record is None:
+                continue
+            if record.expiry > now:
+                # Extended since it was queued
+                queue.append((record.expiry, key))
+                continue
+            del records[key]
+            self._unindex(key, record.user_id)
+            evicted += 1
+        return evicted
+
+    def has_expired(self, now: float) -> bool:
+        queue = self.expiry_queue
+        return bool(queue) and queue[0][0] <= now
+
+    def count(self) -> int:
+        return len(self.records)
+
+
+class PersistentMemorySessionStore(MemorySessionStore):
+    """
+    In-memory store that also records every change in a SessionLog, so the
+    sessions survive a restart. load() rebuilds the records from the log.
+
+    The log is flushed on every expiry sweep and compacted into a new snapshot
+    when it holds more than `compact_ratio` records per live session (and at
+    least `compact_min_records`), and on close(). The sweep only copies the
+    record references, the snapshot is packed and fsynced in a background thread.
+    Only UUID tokens and user ids are persisted.
+    """
+
+    def __init__(self, path: str, compact_ratio: float = 4, compact_min_records: int = 100000):
+        super().__init__()
+        self.log = SessionLog(path)
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Snapshot being written in the background
+        self.compaction: Optional[Future] = None
+
+    def load(self, now: float) -> int:
+        # Millions of new objects would trigger the cyclic GC over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._load(now)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load(self, now: float) -> int:
+        sessions, flags = self.log.replay()
+        records = self.records
+        index = self._index
+        queue = []
+        user_ids: dict[bytes, str] = {}
+        in_order = True
+        last_expiry = 0.0
+        # The log stores the same 16-byte keys, so only user ids need converting
+        for key, (packed_user, expiry) in sessions.items():
+            if expiry <= now:
+                continue
+            user_id = user_ids.get(packed_user)
+            if user_id is None:
+                user_id = user_ids[packed_user] = sys.intern(unpack_id(packed_user))
+            token_flags = flags.get(key)
+            records[key] = SessionRecord(user_id, expiry, frozenset(token_flags) if token_flags else NO_FLAGS)
+            index(key, user_id)
+            queue.append((expiry, key))
+            if expiry < last_expiry:
+                in_order = False
+            last_expiry = expiry
+        # Extended sessions are replayed at their first position
+        if not in_order:
+            queue.sort(key=itemgetter(0))
+        self.expiry_queue.extend(queue)
+        self.log.open()
+        return len(queue)
+
+    def _create(self, key, user_id: str, expiry: float):
+        super()._create(key, user_id, expiry)
+        if type(key) is bytes:
+            packed_user = pack_id(user_id)
+            if packed_user:
+                self.log.append(OP_CREATE, key, packed_user, expiry)
+
+    def _delete(self, key) -> bool:
+        deleted = super()._delete(key)
+        if deleted and type(key) is bytes:
+            self.log.append(OP_DELETE, key)
+        return deleted
+
+    def _set_expiry(self, key, expiry: float, now: float) -> bool:
+        updated = super()._set_expiry(key, expiry, now)
+        if updated and type(key) is bytes:
+            self.log.append(OP_EXPIRY, key, value=expiry)
+        return updated
+
+    def _log_flag(self, op: int, key, flag: str):
+        flag_id = self.log.flag_id(flag) if type(key) is bytes else None
+        if flag_id is not None:
+            self.log.append(op, key, value=flag_id)
+
+    def _add_flag(self, key, flag: str) -> bool:
+        added = super()._add_flag(key, flag)
+        if added:
+            self._log_flag(OP_FLAG_ADD, key, flag)
+        return added
+
+    def _remove_flag(self, key, flag: str) -> bool:
+        removed = super()._remove_flag(key, flag)
+        if removed:
+            self._log_flag(OP_FLAG_REMOVE, key, flag)
+        return removed
+
+    def evict_expired(self, now: float, limit: int = 0) -> int:
+        evicted = super().evict_expired(now, limit)
+        if self.compaction is not None and self.compaction.done():
+            error = self.compaction.exception()
+            if error is not None:
+                # The old log is kept and merged into the next snapshot
+                logger.error("Writing the session snapshot failed: %s", error)
+            self.compaction = None
+        if self.compaction is None and self.log.records > max(
+            self.compact_min_records, self.compact_ratio * len(self.records)
+        ):
+            self.compact(background=True)
+        else:
+            self.log.flush()
+        return evicted
+
+    def compact(self, background: bool = False):
+        """
+        Writes all live sessions as a new snapshot and starts an empty log.
+        With `background`, the snapshot is written in a thread (see `compaction`).
+        """
+        # A shallow copy is enough: every later change is also in the new log, and
+        # replaying it on a record the thread read after the change gives the same result.
+        # Lists of the existing objects, new tuples for a million sessions would set off
+        # full GC passes on the event loop.
+        keys = list(self.records)
+        records = list(self.records.values())
+        flag_ids = self.log.rotate()
+        if not background:
+            self._write_snapshot(keys, records, flag_ids)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-snapshot")
+        self.compaction = self.executor.submit(self._write_snapshot, keys, records, flag_ids)
+
+    def _write_snapshot(self, keys: list, records: list, flag_ids: dict[str, int]):
+        packed_users: dict[str, Optional[bytes]] = {}
+
+        def sessions():
+            # A generator, so the tuples are freed right away and don't pile up for the GC
+            for key, record in zip(keys, records):
+                if type(key) is not bytes:
+                    continue
+                packed_user = packed_users.get(record.user_id, False)
+                if packed_user is False:
+                    packed_user = packed_users[record.user_id] = pack_id(record.user_id)
+                if packed_user:
+                    yield key, packed_user, record.expiry, record.flags
+
+        self.log.write_snapshot(sessions(), flag_ids)
+
+    def close(self):
+        if self.compaction is not None:
+            # A failed snapshot is retried right below
+            self.compaction.exception()
+            self.compaction = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.compact()
+        self.log.close()
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite table in WAL mode, so that all worker processes
+    on the same host see the same sessions.
+    Writes can wait up to `busy_timeout_ms` for another worker's write lock, so the
+    store is `blocking`: SessionManager callers on the event loop run its calls in a
+    thread. Calls from several threads are serialized on the one connection.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.lock = threading.Lock()
+        # Last counted number of sessions, reported while the connection is busy
+        self.sessions = 0
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " token TEXT PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " flags TEXT NOT NULL DEFAULT '[]',"
+            " expiry REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_sessions_user_id ON sessions (user_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_sessions_expiry ON sessions (expiry)")
+
+    def _execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        with self.lock:
+            return self.conn.execute(sql, parameters)
+
+    def create(self, token: str, user_id: str, expiry: float):
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (token, user_id, flags, expiry) VALUES (?, ?, '[]', ?)",
+            (token, user_id, expiry)
+        )
+
+    def get(self, token: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT user_id, flags, expiry FROM sessions WHERE token = ?", (token,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"user_id": row[0], "flags": json.loads(row[1]), "expiry": row[2]}
+
+    def delete(self, token: str) -> bool:
+        return self._execute("DELETE FROM sessions WHERE token = ?", (token,)).rowcount > 0
+
+    def delete_user(self, user_id: str) -> int:
+        return self._execute("DELETE FROM sessions WHERE user_id = ?", (user_id,)).rowcount
+
+    def tokens_for_user(self, user_id: str) -> set[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT token FROM sessions WHERE user_id = ?", (user_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def active_users(self, user_ids, now: float) -> set[str]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        placeholders = ",".join("?" * len(user_ids))
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT DISTINCT user_id FROM sessions WHERE expiry > ? AND user_id IN ({placeholders})",
+                (now, *user_ids)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def set_expiry(self, token: str, expiry: float, now: float):
+        self._execute("UPDATE sessions SET expiry = ? WHERE token = ? AND expiry > ?", (expiry, token, now))
+
+    def _update_flags(self, token: str, update):
+        # Read-modify-write under a write lock, so concurrent workers don't lose flags
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT flags FROM sessions WHERE token = ?", (token,)).fetchone()
+                if row is not None:
+                    flags = json.loads(row[0])
+                    new_flags = update(flags)
+                    if new_flags != flags:
+                        self.conn.execute(
+                            "UPDATE sessions SET flags = ? WHERE token = ?", (json.dumps(new_flags), token)
+                        )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def add_flag(self, token: str, flag: str):
+        self._update_flags(token, lambda flags: flags if flag in flags else flags + [flag])
+
+    def remove_flag(self, token: str, flag: str):
+        self._update_flags(token, lambda flags: [f for f in flags if f != flag])
+
+    def evict_expired(self, now: float, limit: int = 0) -> int:
+        if not limit:
+            return self._execute("DELETE FROM sessions WHERE expiry <= ?", (now,)).rowcount
+        return self._execute(
+            "DELETE FROM sessions WHERE token IN (SELECT token FROM sessions WHERE expiry <= ? LIMIT ?)",
+            (now, limit)
+        ).rowcount
+
+    def has_expired(self, now: float) -> bool:
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM sessions WHERE expiry <= ? LIMIT 1", (now,)).fetchone()
+        return row is not None
+
+    def count(self) -> int:
+        # Called from metrics collection on the event loop: never wait for a running call
+        if self.lock.acquire(blocking=False):
+            try:
+                self.sessions = self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            finally:
+                self.lock.release()
+        return self.sessions
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_session_store(conf: dict) -> SessionStore:
+    """
+    Builds the session store configured in a [session] config section.
+    """
+    backend = conf.get("backend", "memory")
+    if backend == "memory":
+        if conf.get("persist_path"):
+            return PersistentMemorySessionStore(
+                conf["persist_path"],
+                compact_ratio=conf.get("compact_ratio", 4),
+                compact_min_records=conf.get("compact_min_records", 100000)
+            )
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SqliteSessionStore(
+            conf.get("sqlite_path", "./sessions.db"),
+            busy_timeout_ms=conf.get("sqlite_busy_timeout_ms", 5000)
+        )
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+from typing import Optional
+
+# Only depends on the standard library, so other services (e.g. webapp/main.py)
+# can import it to validate gatekeeper session tokens locally.
+
+VERSION = "v1"
+# HMAC-SHA256 keys shorter than its block of 32 bytes are easier to guess
+MIN_KEY_BYTES = 32
+# Placeholder values that must never be used as a key
+PLACEHOLDER_KEYS = {"change-me", "changeme", "secret"}
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class TokenSigner:
+    """
+    Issues and verifies stateless session tokens of the form
+
+        v1.<payload>.<signature>
+
+    The payload holds user_id, expiry and issue time (unix milliseconds), the
+    session flags at issue time and a random nonce; the signature is an HMAC-SHA256 over
+    version and payload.
+    """
+
+    def __init__(self, key: str):
+        if not key:
+            raise ValueError("A signing key is required for signed session tokens")
+        if key in PLACEHOLDER_KEYS:
+            raise ValueError("The signing key is a placeholder, set a random key")
+        self.key = key.encode("utf-8") if isinstance(key, str) else key
+        if len(self.key) < MIN_KEY_BYTES:
+            raise ValueError(f"The signing key must be at least {MIN_KEY_BYTES} bytes long")
+
+    def _sign(self, payload: str) -> str:
+        message = f"{VERSION}.{payload}".encode("ascii")
+        return _b64encode(hmac.new(self.key, message, hashlib.sha256).digest())
+
+    def issue(self, user_id: str, expiry: float, issued_at: float = None, flags=()) -> str:
+        if issued_at is None:
+            issued_at = time.time()
+        fields = [user_id, str(int(expiry * 1000)), str(int(issued_at * 1000)), ",".join(flags), os.urandom(8).hex()]
+        payload = _b64encode("|".join(fields).encode("utf-8"))
+        return f"{VERSION}.{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str) -> Optional[dict]:
+        """
+        Returns the claims of a correctly signed token, or None.
+        Expiry is not checked here, compare claims["expiry"] with the current time.
+        """
+        # Tokens come from clients: anything but ASCII can not be one of ours
+        if not isinstance(token, str) or not token.isascii():
+            return None
+        try:
+            version, payload, signature = token.split(".")
+        except ValueError:
+            return None
+        if version != VERSION or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            # binascii.Error and UnicodeDecodeError are ValueErrors as well
+            user_id, expiry, issued_at, flags, _ = _b64decode(payload).decode("utf-8").split("|")
+            return {
+                "user_id": user_id,
+                "expiry": int(expiry) / 1000,
+                "issued_at": int(issued_at) / 1000,
+                "flags": flags.split(",") if flags else [],
+            }
+        except ValueError:
+            return None
+
+    def is_valid(self, token: str, now: float = None) -> bool:
+        claims = self.verify(token)
+        return claims is not None and claims["expiry"] > (now if now is not None else time.time())
+
+
+def signing_key(auth: dict) -> str:
+    """
+    The signing key from the GATEKEEPER_SIGNING_KEY environment variable, or from
+    `token_signing_key` of the [auth] config section.
+    """
+    return os.environ.get("GATEKEEPER_SIGNING_KEY") or auth.get("token_signing_key", "")
@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+from sqlalchemy.orm import make_transient_to_detached
+from models import UserModel
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user rows, keyed by id with secondary indexes on
+    normalized email and username.
+
+    Rows are stored as plain dicts; every hit returns a new detached UserModel,
+    so callers can modify it and pass it to UserRepository.update() without
+    touching the cached copy.
+    Writes call invalidate(). Loads that were running while the same user was
+    written are not stored: callers read `generation` before the load, and put()
+    compares it with the generation of the user's last invalidation, so a slow
+    read can not put an outdated row back into the cache. Writes to other users
+    do not affect the load.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 10):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # user_id -> (expires_at, row), least recently used first
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # Secondary indexes, map to user_id
+        self.keys: dict[str, dict[str, str]] = {"email": {}, "username": {}}
+        self.generation = 0
+        # user_id -> generation of its last invalidation, oldest first, bounded by max_entries
+        self.invalidated: OrderedDict[str, int] = OrderedDict()
+        # Newest generation forgotten from `invalidated`: older loads are not stored
+        self.forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _user_id(self, kind: str, key: str) -> str:
+        if kind == "id":
+            return key
+        return self.keys[kind].get(key)
+
+    def get(self, kind: str, key: str) -> Optional[UserModel]:
+        """
+        Looks up a user by "id", "email" (normalized) or "username".
+        """
+        user_id = self._user_id(kind, key)
+        entry = self.entries.get(user_id) if user_id else None
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(user_id)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        user = UserModel(**entry[1])
+        make_transient_to_detached(user)
+        return user
+
+    def put(self, user: UserModel, generation: int):
+        """
+        Stores a freshly loaded user, unless a write happened since `generation` was read.
+        """
+        if generation < self.forgotten or self.invalidated.get(user.id, -1) > generation:
+            return
+        row = user.model_dump()
+        self._remove(row["id"])
+        self.entries[row["id"]] = (time.monotonic() + self.ttl_seconds, row)
+        self.keys["email"][row["email_normalized"]] = row["id"]
+        self.keys["username"][row["username"]] = row["id"]
+        while len(self.entries) > self.max_entries:
+            user_id, _ = next(iter(self.entries.items()))
+            self._remove(user_id)
+            self.evictions += 1
+
+    def invalidate(self, user_id: str):
+        self.generation += 1
+        self.invalidated[user_id] = self.generation
+        self.invalidated.move_to_end(user_id)
+        if len(self.invalidated) > self.max_entries:
+            _, self.forgotten = self.invalidated.popitem(last=False)
+        self._remove(user_id)
+
+    def _remove(self, user_id: str):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        row = entry[1]
+        for kind, key in (("email", row["email_normalized"]), ("username", row["username"])):
+            if self.keys[kind].get(key) == user_id:
+                del self.keys[kind][key]
+
+    def clear(self):
+        self.generation += 1
+        self.invalidated.clear()
+        self.forgotten = self.generation
+        self.entries.clear()
+        for index in self.keys.values():
+            index.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
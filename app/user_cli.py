@@ -0,0 +1,301 @@
+"""
+Bulk import and export of users, and password hash calibration.
+
+Import reads JSONL or CSV records with the fields
+    username, email, and either password (plain text) or hashed_password
+    optional: id, registered_at, last_access (ISO 8601)
+and inserts them in chunks, one executemany INSERT and one transaction per
+chunk. Users whose email (case-insensitive) or username already exists,
+in the database or earlier in the file, are skipped.
+
+Plain-text passwords are hashed with the configured [hashing] algorithm, a
+chunk at a time in a pool of [hashing] workers (one per CPU by default).
+
+Export streams the users table as JSONL or CSV, including password hashes.
+
+Calibrate measures the verify time of a hash algorithm on this machine and
+suggests the work factor for a target latency.
+
+    python app/user_cli.py import users.jsonl
+    python app/user_cli.py import users.csv --batch-size 20000
+    python app/user_cli.py export users.jsonl
+    python app/user_cli.py export - --format csv > users.csv
+    python app/user_cli.py calibrate --algorithm bcrypt --target-ms 100
+
+The database is taken from ./app/config.toml, or the file in GATEKEEPER_CONFIG.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+import tomllib
+import uuid
+from datetime import datetime, timezone
+from typing import Iterator, Optional, TextIO
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from db import create_engine
+from hashing import HashingService
+from models import UserModel
+from user_repository import UserRepository
+from utils import (
+    is_valid_email, is_valid_hash, is_valid_username, normalize_email, calibrate_cost, ALGORITHMS,
+)
+
+FIELDS = ("id", "username", "email", "hashed_password", "registered_at", "last_access")
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def read_records(f: TextIO, fmt: str) -> Iterator:
+    """
+    Yields the raw records: dicts for CSV, the non-empty lines for JSONL.
+    decode_record() turns them into dicts, so a bad line only rejects its record.
+    """
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if line.strip():
+            yield line
+
+
+def decode_record(raw) -> dict:
+    if isinstance(raw, dict):
+        return raw
+    try:
+        record = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise InvalidRecord(f"invalid JSON: {e}")
+    if not isinstance(record, dict):
+        raise InvalidRecord("record is not a JSON object")
+    return record
+
+
+def text_field(record: dict, field: str) -> str:
+    value = record.get(field)
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise InvalidRecord(f"{field} is not a string")
+    return value
+
+
+def parse_time(value: Optional[str], default: datetime) -> datetime:
+    if not value:
+        return default
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidRecord(f"invalid timestamp {value!r}")
+
+
+def to_row(record: dict, now: datetime) -> tuple[dict, Optional[str]]:
+    """
+    Validates an import record and turns it into a usermodel row. Returns the row
+    and the plain-text password still to be hashed (None if the record has a hash).
+    """
+    username = text_field(record, "username").strip()
+    email = text_field(record, "email").strip()
+    if not is_valid_username(username):
+        raise InvalidRecord(f"invalid username {username!r}")
+    if not is_valid_email(email):
+        raise InvalidRecord(f"invalid email {email!r}")
+
+    hashed_password = text_field(record, "hashed_password")
+    password = text_field(record, "password")
+    if hashed_password:
+        if not is_valid_hash(hashed_password):
+            raise InvalidRecord("unsupported password hash format")
+        password = None
+    elif not password:
+        raise InvalidRecord("missing password or hashed_password")
+
+    row = {
+        "id": text_field(record, "id") or str(uuid.uuid4()),
+        "username": username,
+        "email": email,
+        "email_normalized": normalize_email(email),
+        "hashed_password": hashed_password,
+        "registered_at": parse_time(text_field(record, "registered_at"), now),
+        "last_access": parse_time(text_field(record, "last_access"), now),
+    }
+    return row, password
+
+
+async def insert_chunk(engine: AsyncEngine, rows: list[dict]) -> int:
+    """
+    Inserts the rows in one transaction, skipping rows that conflict with a
+    unique index (id, email_normalized, username). Returns the number inserted.
+    """
+    statement = insert(UserModel.__table__).on_conflict_do_nothing()
+    async with engine.begin() as conn:
+        before = (await conn.execute(select(func.total_changes()))).scalar()
+        await conn.execute(statement, rows)
+        after = (await conn.execute(select(func.total_changes()))).scalar()
+    return after - before
+
+
+async def import_users(engine: AsyncEngine, f: TextIO, fmt: str, batch_size: int, log: TextIO, hasher: HashingService) -> dict:
+    stats = {"read": 0, "inserted": 0, "duplicates": 0, "invalid": 0}
+    start = time.perf_counter()
+    now = datetime.now(timezone.utc)
+    rows = []
+    # (row, plain-text password) of the rows in `rows` that still need a hash
+    unhashed = []
+
+    async def flush():
+        # The whole chunk is hashed in parallel, hasher.max_pending must be >= batch_size
+        hashes = await asyncio.gather(*(hasher.hash_password(password) for _, password in unhashed))
+        for (row, _), hashed_password in zip(unhashed, hashes):
+            row["hashed_password"] = hashed_password
+        unhashed.clear()
+        inserted = await insert_chunk(engine, rows)
+        stats["inserted"] += inserted
+        stats["duplicates"] += len(rows) - inserted
+        rows.clear()
+        rate = stats["read"] / (time.perf_counter() - start)
+        print(
+            f"{stats['read']} read, {stats['inserted']} inserted, {stats['duplicates']} duplicates, "
+            f"{stats['invalid']} invalid ({rate:,.0f} records/s)",
+            file=log
+        )
+
+    for number, raw in enumerate(read_records(f, fmt), start=1):
+        stats["read"] += 1
+        try:
+            row, password = to_row(decode_record(raw), now)
+        except InvalidRecord as e:
+            stats["invalid"] += 1
+            print(f"record {number}: {e}", file=log)
+            continue
+        rows.append(row)
+        if password:
+            unhashed.append((row, password))
+        if len(rows) >= batch_size:
+            await flush()
+    if rows:
+        await flush()
+    return stats
+
+
+def format_row(row) -> dict:
+    data = dict(zip(FIELDS, row))
+    for key in ("registered_at", "last_access"):
+        if isinstance(data[key], datetime):
+            data[key] = data[key].isoformat()
+    return data
+
+
+async def export_users(engine: AsyncEngine, out: TextIO, fmt: str, batch_size: int) -> int:
+    """
+    Writes all users in rowid order, reading `batch_size` rows at a time.
+    """
+    table = UserModel.__table__
+    rowid = literal_column("rowid")
+    columns = [table.c[name] for name in FIELDS]
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        writer.writeheader()
+    exported = 0
+    last_rowid = 0
+    async with engine.connect() as conn:
+        while True:
+            # Keyset pagination keeps memory bounded without holding a cursor open
+            rows = (await conn.execute(
+                select(rowid, *columns).where(rowid > last_rowid).order_by(rowid).limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            for row in rows:
+                data = format_row(row[1:])
+                if writer:
+                    writer.writerow(data)
+                else:
+                    out.write(json.dumps(data) + "\n")
+            exported += len(rows)
+            last_rowid = rows[-1][0]
+    return exported
+
+
+def load_config() -> dict:
+    with open(os.environ.get("GATEKEEPER_CONFIG", "./app/config.toml"), "rb") as f:
+        return tomllib.load(f)
+
+
+def calibrate(algorithm: str, target_ms: float) -> int:
+    results = calibrate_cost(algorithm, target_ms)
+    for cost, ms in results:
+        print(f"cost {cost:>2}: {ms:8.1f} ms per verify")
+    within = [cost for cost, ms in results if ms <= target_ms]
+    cost = within[-1] if within else results[0][0]
+    print(f"\n[hashing]\nalgorithm = \"{algorithm}\"\ncost = {cost}")
+    return 0
+
+
+async def run(args) -> int:
+    config = load_config()
+    hasher = None
+    if args.command == "import":
+        hashing = config.get("hashing", {})
+        hasher = HashingService(
+            workers=hashing.get("workers", 0),
+            max_pending=args.batch_size,
+            executor=hashing.get("executor", "process"),
+            algorithm=hashing.get("algorithm", "sha"),
+            cost=hashing.get("cost")
+        )
+        # Forked before the database starts its threads
+        hasher.start()
+    engine = create_engine(config["database"])
+    try:
+        await UserRepository(engine).init_db()
+        if args.command == "import":
+            fmt = args.format or ("csv" if args.file.endswith(".csv") else "jsonl")
+            with open(args.file, newline="", encoding="utf-8") as f:
+                stats = await import_users(engine, f, fmt, args.batch_size, sys.stderr, hasher)
+            print(json.dumps(stats), file=sys.stderr)
+        else:
+            fmt = args.format or ("csv" if args.file.endswith(".csv") else "jsonl")
+            if args.file == "-":
+                exported = await export_users(engine, sys.stdout, fmt, args.batch_size)
+            else:
+                with open(args.file, "w", newline="", encoding="utf-8") as f:
+                    exported = await export_users(engine, f, fmt, args.batch_size)
+            print(f"{exported} users exported", file=sys.stderr)
+    finally:
+        await engine.dispose()
+        if hasher:
+            hasher.shutdown(wait=True)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="import users from a JSONL or CSV file")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--format", choices=["jsonl", "csv"], help="default: from the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=5000)
+    export_parser = commands.add_parser("export", help="export users to a JSONL or CSV file ('-' for stdout)")
+    export_parser.add_argument("file")
+    export_parser.add_argument("--format", choices=["jsonl", "csv"], help="default: from the file extension")
+    export_parser.add_argument("--batch-size", type=int, default=5000)
+    calibrate_parser = commands.add_parser("calibrate", help="suggest a hash work factor for a target verify latency")
+    calibrate_parser.add_argument("--algorithm", choices=[a for a in ALGORITHMS if a != "sha"], default="bcrypt")
+    calibrate_parser.add_argument("--target-ms", type=float, default=100)
+    args = parser.parse_args()
+    if args.command == "calibrate":
+        return calibrate(args.algorithm, args.target_ms)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,347 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from sqlmodel import select, SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import bindparam, func, inspect, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.ext.asyncio import AsyncEngine
-from typing import Optional
+from datetime import datetime
+from typing import AsyncIterator, Optional
 from models import UserModel
+from migrations import upgrade
+from bloom_filter import UserKeyFilter
+from profiler import span
+from user_cache import UserCache
+from utils import normalize_email
+
+
+class DuplicateUserError(Exception):
+    """Raised when a write violates the unique email or username index."""
+
+    def __init__(self, field: str):
+        super().__init__(f"Duplicate {field}")
+        self.field = field
+
+
+def _duplicate_field(error: IntegrityError) -> Optional[str]:
+    # SQLite reports e.g. "UNIQUE constraint failed: usermodel.email_normalized"
+    message = str(error.orig)
+    if "usermodel.email_normalized" in message:
+        return "email"
+    if "usermodel.username" in message:
+        return "username"
+    return None
+
+
+def _detached(row: dict) -> UserModel:
+    user = UserModel(**row)
+    make_transient_to_detached(user)
+    return user
+
+
+def _keys_changed(user: UserModel) -> bool:
+    state = inspect(user)
+    return state.attrs.email.history.has_changes() or state.attrs.username.history.has_changes()
+
+
+def _lookup_keys(user: UserModel) -> set[tuple[str, str]]:
+    """(kind, key) of every lookup that can return the user, before and after its pending changes."""
+    state = inspect(user)
+    keys = {("id", user.id), ("email", user.email_normalized), ("username", user.username)}
+    for email in state.attrs.email.history.deleted:
+        keys.add(("email", normalize_email(email)))
+    for username in state.attrs.username.history.deleted:
+        keys.add(("username", username))
+    return keys
+
+
+class UserUnitOfWork:
+    """
+    Lookups and writes of one request, written on one AsyncSession.
+    Created by UserRepository.unit_of_work(), which commits on success.
+
+    While nothing is pending, lookups load through UserRepository._load in a session of
+    their own (shared with concurrent lookups of the same key), so a login uses two
+    sessions: one for the lookup and the unit of work's for the write. Once changes are
+    pending, lookups query through the unit of work's session, which flushes them first.
+
+    Users returned by the lookups are attached to the session, so changing their
+    attributes is enough to have them written on commit. Uniqueness of email and
+    username is left to the database: commit() raises DuplicateUserError.
+    """
+
+    def __init__(self, repo: "UserRepository", session: AsyncSession):
+        self.repo = repo
+        self.session = session
+
+    def _attach(self, user: UserModel) -> UserModel:
+        # A user may already be in the session if it was looked up by another key
+        key = inspect(UserModel).identity_key_from_primary_key((user.id,))
+        existing = self.session.sync_session.identity_map.get(key)
+        if existing is not None:
+            return existing
+        self.session.add(user)
+        return user
+
+    async def _get(self, kind: str, key: str, condition) -> Optional[UserModel]:
+        cache = self.repo.cache
+        if cache:
+            user = cache.get(kind, key)
+            if user is not None:
+                return self._attach(user)
+            generation = cache.generation
+        if not self.repo.might_exist(kind, key):
+            return None
+        if self.session.new or self.session.dirty or self.session.deleted:
+            # Query through the session, so the pending changes are flushed first
+            with span("user_lookup"):
+                result = await self.session.exec(select(UserModel).where(condition))
+            user = result.first()
+        else:
+            # Nothing to write yet: load outside the session, shared with concurrent
+            # lookups of the same key, and no connection is held while the request
+            # awaits e.g. password verification
+            row = await self.repo._load(kind, key, condition)
+            user = self._attach(_detached(row)) if row else None
+        if cache and user is not None:
+            cache.put(user, generation)
+        return user
+
+    async def get_user_by_email(self, email: str) -> Optional[UserModel]:
+        email = normalize_email(email)
+        return await self._get("email", email, UserModel.email_normalized == email)
+
+    async def get_user_by_username(self, username: str) -> Optional[UserModel]:
+        return await self._get("username", username, UserModel.username == username)
+
+    async def get_user_by_id(self, user_id: str) -> Optional[UserModel]:
+        return await self._get("id", user_id, UserModel.id == user_id)
+
+    def add(self, user: UserModel):
+        self.session.add(user)
+
+    async def commit(self):
+        users = [obj for obj in self.session.new | self.session.dirty if isinstance(obj, UserModel)]
+        for user in users:
+            user.email_normalized = normalize_email(user.email)
+        # Rollback expires the instances, so read the ids and keys up front
+        user_ids = [user.id for user in users]
+        lookup_keys = set().union(*(_lookup_keys(user) for user in users))
+        keys = [
+            (user.email_normalized, user.username) for user in users
+            if user in self.session.new or _keys_changed(user)
+        ]
+        try:
+            with span("user_commit"):
+                await self.session.commit()
+            key_filter = self.repo.key_filter
+            if key_filter:
+                for email, username in keys:
+                    key_filter.add("email", email)
+                    key_filter.add("username", username)
+        except IntegrityError as e:
+            await self.session.rollback()
+            field = _duplicate_field(e)
+            if field is None:
+                raise
+            raise DuplicateUserError(field) from e
+        finally:
+            self.repo._forget_lookups(lookup_keys)
+            if self.repo.cache:
+                for user_id in user_ids:
+                    self.repo.cache.invalidate(user_id)
+
 
 class UserRepository:
-    def __init__(self, engine: AsyncEngine):
+    def __init__(self, engine: AsyncEngine, cache: Optional[UserCache] = None, key_filter: Optional[UserKeyFilter] = None):
         self.engine = engine
+        # Optional read-through cache for the get_user_by_* lookups
+        self.cache = cache
+        # Optional filter that answers lookups of unknown emails and usernames without a query
+        self.key_filter = key_filter
+        # Single flight: (kind, key) -> task of the lookup query in progress.
+        # Writes remove the keys they touch, later lookups of those keys start a new query.
+        self.in_flight: dict[tuple[str, str], asyncio.Task] = {}
+        # Lookups that were answered by another caller's query
+        self.coalesced_queries = 0
+
+    def might_exist(self, kind: str, key: str) -> bool:
+        if kind == "id" or not self.key_filter:
+            return True
+        return self.key_filter.might_exist(kind, key)
+
+    async def build_filter(self, batch_size: int = 10000):
+        """
+        (Re)builds the key filter by streaming the emails and usernames of all users.
+        Lookups use the previous filter until the new one is complete.
+        """
+        table = UserModel.__table__
+        start = time.perf_counter()
+        try:
+            async with self.engine.connect() as conn:
+                users = (await conn.execute(select(func.count()).select_from(table))).scalar()
+                bloom = self.key_filter.start_build(users)
+                result = await conn.stream(
+                    select(table.c.email_normalized, table.c.username).execution_options(yield_per=batch_size)
+                )
+                async for rows in result.partitions():
+                    for email, username in rows:
+                        bloom.add(f"email:{email}")
+                        bloom.add(f"username:{username}")
+        except BaseException:
+            self.key_filter.abort_build()
+            raise
+        self.key_filter.finish_build(bloom, time.perf_counter() - start)
+
+    async def run_filter_rebuild(self, interval: float):
+        """
+        Rebuilds the key filter every `interval` seconds, or sooner once it holds
+        more keys than it was sized for. Runs until cancelled.
+        """
+        built_at = time.monotonic()
+        while True:
+            await asyncio.sleep(min(interval, 10))
+            if time.monotonic() - built_at >= interval or self.key_filter.over_capacity():
+                await self.build_filter()
+                built_at = time.monotonic()
 
     async def init_db(self):
         async with self.engine.begin() as conn:
             await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(upgrade)
+
+    @asynccontextmanager
+    async def unit_of_work(self) -> AsyncIterator[UserUnitOfWork]:
+        """
+        Runs the lookups and the write of one request; the write uses one session.
+        Commits when the block exits normally and rolls back on exceptions.
+        """
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            uow = UserUnitOfWork(self, session)
+            yield uow
+            await uow.commit()
 
     async def save(self, user: UserModel):
-        async with AsyncSession(self.engine) as session:
-            session.add(user)
-            await session.commit()
+        async with self.unit_of_work() as uow:
+            uow.add(user)
 
     async def update(self, user: UserModel):
+        async with self.unit_of_work() as uow:
+            uow.add(user)
+
+    async def update_last_access(self, last_access: dict[str, datetime]):
+        """
+        Writes {user_id: last_access} in one executemany UPDATE.
+        """
+        if not last_access:
+            return
+        table = UserModel.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("user_id"))
+            .values(last_access=bindparam("last_access"))
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                statement,
+                [{"user_id": user_id, "last_access": value} for user_id, value in last_access.items()]
+            )
+        # Lookups by email or username of these users may still join an older query,
+        # at worst they see the previous last_access
+        self._forget_lookups(("id", user_id) for user_id in last_access)
+        if self.cache:
+            for user_id in last_access:
+                self.cache.invalidate(user_id)
+
+    async def _query(self, condition) -> Optional[dict]:
         async with AsyncSession(self.engine) as session:
-            session.add(user)
-            await session.commit()
+            result = await session.exec(select(UserModel).where(condition))
+            user = result.first()
+            return user.model_dump() if user else None
+
+    def _forget_lookups(self, keys):
+        """
+        Called after a write: queries in flight for these keys may have read the
+        previous row, so later lookups must not join them. Their current waiters
+        still get their result.
+        """
+        for key in keys:
+            self.in_flight.pop(key, None)
+
+    async def _load(self, kind: str, key: str, condition) -> Optional[dict]:
+        """
+        Loads the row of a user. Concurrent calls for the same key share one query;
+        its result or exception is returned to all of them.
+        """
+        flight_key = (kind, key)
+        flight = self.in_flight.get(flight_key)
+        if flight is not None:
+            self.coalesced_queries += 1
+        else:
+            flight = asyncio.ensure_future(self._query(condition))
+            self.in_flight[flight_key] = flight
+
+            def done(task: asyncio.Task):
+                if self.in_flight.get(flight_key) is task:
+                    del self.in_flight[flight_key]
+
+            flight.add_done_callback(done)
+        # A cancelled caller must not cancel the query of the others
+        with span("user_lookup"):
+            return await asyncio.shield(flight)
+
+    async def _get(self, kind: str, key: str, condition) -> Optional[UserModel]:
+        if self.cache:
+            user = self.cache.get(kind, key)
+            if user is not None:
+                return user
+            generation = self.cache.generation
+        if not self.might_exist(kind, key):
+            return None
+        row = await self._load(kind, key, condition)
+        # Every caller gets its own instance
+        user = _detached(row) if row else None
+        if self.cache and user is not None:
+            self.cache.put(user, generation)
+        return user
 
     async def get_user_by_email(self, email: str) -> Optional[UserModel]:
-        async with AsyncSession(self.engine) as session:
-            result = await session.exec(select(UserModel).where(UserModel.email == email))
-            return result.first()
+        email = normalize_email(email)
+        return await self._get("email", email, UserModel.email_normalized == email)
 
     async def get_user_by_username(self, username: str) -> Optional[UserModel]:
-        async with AsyncSession(self.engine) as session:
-            result = await session.exec(select(UserModel).where(UserModel.username == username))
-            return result.first()
+        return await self._get("username", username, UserModel.username == username)
 
     async def get_user_by_id(self, user_id: str) -> Optional[UserModel]:
+        return await self._get("id", user_id, UserModel.id == user_id)
+
+    async def _get_many(self, kind: str, keys: list[str], column) -> list[UserModel]:
+        users = []
+        missing = []
+        for key in dict.fromkeys(keys):
+            user = self.cache.get(kind, key) if self.cache else None
+            if user is not None:
+                users.append(user)
+            elif self.might_exist(kind, key):
+                missing.append(key)
+        if not missing:
+            return users
+        generation = self.cache.generation if self.cache else 0
         async with AsyncSession(self.engine) as session:
-            result = await session.exec(select(UserModel).where(UserModel.id == user_id))
-            return result.first()
+            result = await session.exec(select(UserModel).where(column.in_(missing)))
+            loaded = result.all()
+        if self.cache:
+            for user in loaded:
+                self.cache.put(user, generation)
+        return users + list(loaded)
+
+    async def get_users_by_ids(self, user_ids: list[str]) -> list[UserModel]:
+        return await self._get_many("id", user_ids, UserModel.id)
+
+    async def get_users_by_emails(self, emails: list[str]) -> list[UserModel]:
+        return await self._get_many("email", [normalize_email(email) for email in emails], UserModel.email_normalized)
+
+    async def get_users_by_usernames(self, usernames: list[str]) -> list[UserModel]:
+        return await self._get_many("username", usernames, UserModel.username)
@@ -1,12 +1,44 @@
-from hashlib import sha256
+from base64 import b64decode, b64encode
+from hashlib import scrypt, sha256
+from hmac import compare_digest
 from os import urandom
+from typing import Optional
 import re
+import time
+import bcrypt
 
+# Supported values of [hashing] algorithm. "sha" is the original salted double
+# SHA-256 and only kept to verify old hashes; its cost can not be tuned.
+ALGORITHMS = ("sha", "bcrypt", "scrypt")
 
-def hash_password(password: str, salt=None) -> str:
+# Work factors are log2 values: bcrypt rounds, scrypt N = 2**cost (r=8, p=1)
+DEFAULT_COST = {"sha": 0, "bcrypt": 12, "scrypt": 15}
+MIN_COST = {"sha": 0, "bcrypt": 4, "scrypt": 10}
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# bcrypt only uses the first 72 bytes of a password (newer bcrypt versions raise instead)
+BCRYPT_MAX_BYTES = 72
+
+
+def hash_password(password: str, salt=None, algorithm: str = "sha", cost: Optional[int] = None) -> str:
     """
-    Hashes the password, salts it, then hashes it again.
+    Hashes the password with the given algorithm and work factor.
+    For "sha", the password is hashed, salted, then hashed again; `salt` is only used there.
     """
+    if cost is None:
+        cost = DEFAULT_COST[algorithm]
+    if algorithm == "bcrypt":
+        hashed = bcrypt.hashpw(password.encode('utf-8')[:BCRYPT_MAX_BYTES], bcrypt.gensalt(rounds=cost))
+        return hashed.decode('ascii')
+    if algorithm == "scrypt":
+        scrypt_salt = urandom(16)
+        key = _scrypt(password, scrypt_salt, cost, SCRYPT_R, SCRYPT_P)
+        params = f"ln={cost},r={SCRYPT_R},p={SCRYPT_P}"
+        return f"$scrypt${params}${b64encode(scrypt_salt).decode()}${b64encode(key).decode()}"
+    if algorithm != "sha":
+        raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+
     if not salt:
         salt = generate_salt()
     first_hash = sha256(password.encode('utf-8')).hexdigest()
@@ -16,6 +48,12 @@ def hash_password(password: str, salt=None) -> str:
     return f"$SHA${salt}${hashcode}"
 
 
+def _scrypt(password: str, salt: bytes, cost: int, r: int, p: int) -> bytes:
+    n = 2 ** cost
+    # OpenSSL refuses more than 32 MiB by default, scrypt needs about 128 * r * n bytes
+    return scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p), dklen=32)
+
+
 def generate_salt(length=16) -> str:
     """
     Generate a random hexadecimal string of a given length
@@ -23,17 +61,89 @@ def generate_salt(length=16) -> str:
     return urandom((length+1)//2).hex()[:length]
 
 
+def hash_parameters(stored_hash: str) -> tuple[str, int]:
+    """
+    Returns (algorithm, cost) of a stored hash, ("", 0) if the format is unknown.
+    """
+    parts = stored_hash.split('$')
+    if len(parts) < 4:
+        return "", 0
+    if parts[1] == "SHA":
+        return "sha", 0
+    if parts[1] in ("2a", "2b", "2y") and parts[2].isdigit():
+        return "bcrypt", int(parts[2])
+    if parts[1] == "scrypt":
+        params = dict(item.split('=', 1) for item in parts[2].split(',') if '=' in item)
+        if params.get("ln", "").isdigit():
+            return "scrypt", int(params["ln"])
+    return "", 0
+
+
 def verify_password(stored_hash: str, password: str) -> bool:
     """
-    Verifies the password against the stored hash.
+    Verifies the password against the stored hash, using the algorithm named in the hash.
     """
     try:
-        _, algorithm, salt, hashcode = stored_hash.split('$')
-        return hash_password(password, salt) == stored_hash
-    except ValueError:
+        parts = stored_hash.split('$')
+        algorithm = parts[1]
+        if algorithm == "SHA":
+            _, algorithm, salt, hashcode = parts
+            return compare_digest(hash_password(password, salt), stored_hash)
+        if algorithm in ("2a", "2b", "2y"):
+            return bcrypt.checkpw(password.encode('utf-8')[:BCRYPT_MAX_BYTES], stored_hash.encode('ascii'))
+        if algorithm == "scrypt":
+            _, _, params, salt, key = parts
+            params = dict(item.split('=', 1) for item in params.split(','))
+            expected = b64decode(key)
+            actual = _scrypt(password, b64decode(salt), int(params["ln"]), int(params["r"]), int(params["p"]))
+            return compare_digest(actual, expected)
+        return False
+    except (ValueError, KeyError, IndexError):
         return False
 
 
+def needs_rehash(stored_hash: str, algorithm: str, cost: Optional[int] = None) -> bool:
+    """
+    True if the stored hash does not use the given algorithm and work factor.
+    """
+    if cost is None:
+        cost = DEFAULT_COST[algorithm]
+    return hash_parameters(stored_hash) != (algorithm, cost if algorithm != "sha" else 0)
+
+
+def calibrate_cost(algorithm: str, target_ms: float, max_cost: int = 20) -> list[tuple[int, float]]:
+    """
+    Measures the verify time of increasing work factors, starting at the minimum,
+    until one takes longer than `target_ms`. Returns [(cost, milliseconds)].
+    Every step doubles the work, so measuring stops after about twice the target.
+    """
+    results = []
+    for cost in range(MIN_COST[algorithm], max_cost + 1):
+        stored_hash = hash_password("Calibrate1", algorithm=algorithm, cost=cost)
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            verify_password(stored_hash, "Calibrate1")
+            timings.append((time.perf_counter() - start) * 1000)
+        results.append((cost, sorted(timings)[1]))
+        if results[-1][1] > target_ms:
+            break
+    return results
+
+
+def is_valid_hash(stored_hash: str) -> bool:
+    """
+    Checks that a pre-hashed password is in a format verify_password understands:
+    $SHA$<salt>$<sha256 hex>, bcrypt ($2b$<rounds>$...) or $scrypt$ln=..,r=..,p=..$<salt>$<key>.
+    """
+    patterns = (
+        r"\$SHA\$[^$]+\$[0-9a-f]{64}",
+        r"\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}",
+        r"\$scrypt\$ln=\d+,r=\d+,p=\d+\$[A-Za-z0-9+/]+={0,2}\$[A-Za-z0-9+/]+={0,2}",
+    )
+    return any(re.fullmatch(pattern, stored_hash) for pattern in patterns)
+
+
 def is_valid_password(password: str) -> bool:
     """
     Password must be at least 7 characters, include one uppercase letter,
@@ -58,6 +168,13 @@ def is_valid_email(email: str) -> bool:
     return bool(email_regex.match(email))
 
 
+def normalize_email(email: str) -> str:
+    """
+    Case-normalized form of an email, used for lookups and uniqueness.
+    """
+    return email.strip().lower()
+
+
 def is_valid_username(username: str) -> bool:
     """
     Username must be 3-32 characters, only alphanumerics and underscores.
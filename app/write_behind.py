@@ -0,0 +1,63 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class LastAccessBuffer:
+    """
+    Collects last_access updates in memory and writes them in one batched UPDATE,
+    either every `flush_interval_ms` or as soon as `max_entries` users are pending.
+    get() returns buffered values, so readers see the latest login before it is flushed.
+    """
+
+    def __init__(self, repo, flush_interval_ms: int = 500, max_entries: int = 1000):
+        self.repo = repo
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_entries = max_entries
+        # user_id -> last_access, not yet written
+        self.pending: dict[str, datetime] = {}
+        # Batch that is currently being written
+        self.flushing: dict[str, datetime] = {}
+        self.flushed = 0
+        self._full = asyncio.Event()
+
+    def record(self, user_id: str, last_access: datetime):
+        self.pending[user_id] = last_access
+        if len(self.pending) >= self.max_entries:
+            self._full.set()
+
+    def get(self, user_id: str) -> Optional[datetime]:
+        return self.pending.get(user_id) or self.flushing.get(user_id)
+
+    async def flush(self):
+        if not self.pending or self.flushing:
+            return
+        self.flushing, self.pending = self.pending, {}
+        try:
+            await self.repo.update_last_access(self.flushing)
+            self.flushed += len(self.flushing)
+        except BaseException:
+            # Keep the batch for the next attempt (also when cancelled), newer logins win
+            self.pending = {**self.flushing, **self.pending}
+            raise
+        finally:
+            self.flushing = {}
+
+    async def run(self):
+        """
+        Flushes periodically until cancelled. Failed flushes are logged and retried.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # The batch is back in pending, retry on the next round
+                logger.exception("Flushing %d last_access updates failed", len(self.pending))
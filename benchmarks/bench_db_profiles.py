@@ -0,0 +1,78 @@
+"""
+Registration and login throughput of the database profiles in app/db.py.
+
+Runs the database part of /register-user (insert) and /login-user
+(lookup + last_access update) through UserRepository.unit_of_work on a
+fresh temporary database per profile. Password hashing is left out.
+
+    python benchmarks/bench_db_profiles.py --users 5000 --concurrency 32
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+from db import PROFILES, create_engine
+from models import UserModel
+from user_repository import UserRepository
+
+
+async def run_concurrently(jobs, concurrency: int) -> float:
+    queue = list(jobs)
+    queue.reverse()
+
+    async def worker():
+        while queue:
+            await queue.pop()()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+async def bench_profile(profile: str, users: int, concurrency: int, pool_size: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine({
+            "url": f"sqlite+aiosqlite:///{tmp}/users.db",
+            "profile": profile,
+            "pool_size": pool_size,
+            "max_overflow": 0,
+            "pool_timeout": 300,
+        })
+        repo = UserRepository(engine)
+        await repo.init_db()
+
+        async def register(i: int):
+            async with repo.unit_of_work() as uow:
+                uow.add(UserModel(username=f"user{i}", email=f"user{i}@example.com", hashed_password="$SHA$x$y"))
+
+        async def login(i: int):
+            async with repo.unit_of_work() as uow:
+                user = await uow.get_user_by_email(f"user{i}@example.com")
+                user.last_access = datetime.now(timezone.utc)
+
+        register_time = await run_concurrently((lambda i=i: register(i) for i in range(users)), concurrency)
+        login_time = await run_concurrently((lambda i=i: login(i) for i in range(users)), concurrency)
+        await engine.dispose()
+
+    print(f"{profile:>8}: register {users / register_time:>8,.0f}/s | login {users / login_time:>8,.0f}/s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--pool-size", type=int, default=5)
+    parser.add_argument("--profiles", default=",".join(PROFILES))
+    args = parser.parse_args()
+
+    for profile in args.profiles.split(","):
+        await bench_profile(profile, args.users, args.concurrency, args.pool_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
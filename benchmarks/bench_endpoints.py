@@ -0,0 +1,300 @@
+"""
+Load benchmark of the gatekeeper API endpoints.
+
+Starts gatekeeper on a fresh temporary SQLite database, seeds users and
+replays a mixed workload of register, login, get-user-data, modify and
+logout requests at a fixed concurrency. Prints throughput and p50/p95/p99
+latency per endpoint as JSON, so runs on different commits can be diffed.
+
+By default the FastAPI app is driven in-process over ASGI (no network, no
+server); `--mode uvicorn` starts a real uvicorn server in a subprocess instead.
+
+    python benchmarks/bench_endpoints.py --requests 20000 --concurrency 32
+    python benchmarks/bench_endpoints.py --mix login=1 --output before.json
+    python benchmarks/bench_endpoints.py --mode uvicorn --port 8765
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).parent.parent
+APP_DIR = ROOT / "app"
+PASSWORD = "Bench@12345"
+DEFAULT_MIX = "register=1,login=4,get=8,modify=1,logout=2"
+ENDPOINTS = {
+    "register": "/register-user",
+    "login": "/login-user",
+    "get": "/get-user-data",
+    "modify": "/modify-user",
+    "logout": "/logout-user",
+}
+
+
+def toml_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return json.dumps(value)
+    if isinstance(value, list):
+        return "[" + ", ".join(toml_value(v) for v in value) + "]"
+    raise TypeError(f"Unsupported config value: {value!r}")
+
+
+def write_config(tmp: Path, args) -> Path:
+    """
+    Copies app/config.toml with a temporary database, no login rate limits
+    and in-memory sessions. `args.algorithm`, if set, overrides the password hashing.
+    """
+    with open(APP_DIR / "config.toml", "rb") as f:
+        config = tomllib.load(f)
+    config["database"]["url"] = f"sqlite+aiosqlite:///{tmp / 'users.db'}"
+    config["ratelimit"]["max_attempts"] = 10 ** 9
+    config["ratelimit"]["ip_max_attempts"] = 0
+    config.setdefault("session", {})["backend"] = "memory"
+    if args.profile:
+        config["database"]["profile"] = args.profile
+    if getattr(args, "algorithm", None):
+        config["hashing"]["algorithm"] = args.algorithm
+    config["server"]["host"] = "127.0.0.1"
+    config["server"]["port"] = args.port
+    config["server"]["uds"] = ""
+
+    lines = []
+    for section, values in config.items():
+        lines.append(f"[{section}]")
+        lines.extend(f"{key} = {toml_value(value)}" for key, value in values.items())
+        lines.append("")
+    path = tmp / "config.toml"
+    path.write_text("\n".join(lines))
+    return path
+
+
+def seed(db_path: Path, users: int) -> list[dict]:
+    """
+    Inserts `users` users sharing one password hash directly into the database.
+    The tables have been created by the app's startup at this point.
+    """
+    sys.path.insert(0, str(APP_DIR))
+    from utils import hash_password
+
+    hashed = hash_password(PASSWORD)
+    now = datetime.now().isoformat(sep=" ")
+    seeded = [
+        {"id": str(uuid.uuid4()), "username": f"bench{i}", "email": f"bench{i}@example.com"}
+        for i in range(users)
+    ]
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO usermodel (id, username, email, email_normalized, hashed_password, registered_at, last_access)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(u["id"], u["username"], u["email"], u["email"], hashed, now, now) for u in seeded]
+    )
+    conn.commit()
+    conn.close()
+    return seeded
+
+
+def parse_mix(mix: str) -> tuple[list[str], list[float]]:
+    ops, weights = [], []
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in ENDPOINTS:
+            raise SystemExit(f"Unknown operation in --mix: {op}")
+        ops.append(op)
+        weights.append(float(weight or 1))
+    return ops, weights
+
+
+async def replay(client: httpx.AsyncClient, api_token: str, users: list[dict], args) -> tuple[dict, float]:
+    ops, weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    plan = rng.choices(ops, weights=weights, k=args.requests)
+    latencies = {op: [] for op in ENDPOINTS}
+    errors = {op: 0 for op in ENDPOINTS}
+    sessions: list[str] = []
+    registered = 0
+    position = 0
+
+    async def call(op: str, payload: dict) -> httpx.Response:
+        start = time.perf_counter()
+        response = await client.post(ENDPOINTS[op], json={"api_token": api_token, **payload})
+        latencies[op].append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors[op] += 1
+        return response
+
+    async def login(user: dict):
+        response = await call("login", {"email": user["email"], "password": PASSWORD})
+        if response.status_code == 200:
+            sessions.append(response.json()["session_token"])
+
+    async def worker(worker_id: int):
+        nonlocal registered, position
+        wrng = random.Random(args.seed + worker_id)
+        while position < len(plan):
+            op = plan[position]
+            position += 1
+            user = wrng.choice(users)
+            if op == "register":
+                registered += 1
+                name = f"new{worker_id}x{registered}"
+                await call(op, {"username": name, "email": f"{name}@example.com", "password": PASSWORD})
+            elif op == "login":
+                await login(user)
+            elif op == "get":
+                await call(op, {"id": user["id"]})
+            elif not sessions:
+                # modify and logout need a session
+                await login(user)
+            elif op == "modify":
+                token = sessions[wrng.randrange(len(sessions))]
+                await call(op, {"session_token": token, "password": PASSWORD})
+            else:
+                token = sessions.pop(wrng.randrange(len(sessions)))
+                await call(op, {"session_token": token})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"latencies": latencies, "errors": errors}, elapsed
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def summarize(results: dict, elapsed: float) -> dict:
+    endpoints = {}
+    all_latencies = []
+    for op, values in results["latencies"].items():
+        if not values:
+            continue
+        all_latencies.extend(values)
+        endpoints[ENDPOINTS[op]] = {
+            "requests": len(values),
+            "errors": results["errors"][op],
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+        }
+    return {
+        "requests": len(all_latencies),
+        "errors": sum(results["errors"].values()),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(all_latencies) / elapsed, 1),
+        "p50_ms": round(percentile(all_latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(all_latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(all_latencies, 99) * 1000, 3),
+        "endpoints": endpoints,
+    }
+
+
+async def run_asgi(tmp: Path, args) -> tuple[dict, float]:
+    sys.path.insert(0, str(APP_DIR))
+    import main
+
+    # httpx.ASGITransport does not send lifespan events, so run the startup here
+    async with main.app.router.lifespan_context(main.app):
+        users = seed(tmp / "users.db", args.users)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://gatekeeper") as client:
+            return await replay(client, main.valid_tokens[0], users, args)
+
+
+async def run_uvicorn(tmp: Path, config_path: Path, args) -> tuple[dict, float]:
+    env = dict(os.environ, GATEKEEPER_CONFIG=str(config_path))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(APP_DIR),
+         "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=ROOT, env=env
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/docs")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise SystemExit("uvicorn did not start")
+            users = seed(tmp / "users.db", args.users)
+            with open(config_path, "rb") as f:
+                api_token = tomllib.load(f)["auth"]["valid_tokens"][0]
+            return await replay(client, api_token, users, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--requests", type=int, default=10000, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=1000, help="number of seeded users")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of register, login, get, modify, logout")
+    parser.add_argument("--profile", help="override database.profile (default, safe, fast)")
+    parser.add_argument("--port", type=int, default=8765, help="port for --mode uvicorn")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        config_path = write_config(tmp, args)
+        if args.mode == "asgi":
+            # main.py reads its config on import
+            os.environ["GATEKEEPER_CONFIG"] = str(config_path)
+            os.chdir(ROOT)
+            results, elapsed = asyncio.run(run_asgi(tmp, args))
+        else:
+            results, elapsed = asyncio.run(run_uvicorn(tmp, config_path, args))
+
+    report = {
+        "commit": current_commit(),
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "seeded_users": args.users,
+        "mix": args.mix,
+        **summarize(results, elapsed),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compares memory and throughput of the rate limiter algorithms.
+
+Simulates a credential-stuffing run where every attempt uses a new email,
+followed by a run that hammers a small set of emails.
+
+    python benchmarks/bench_rate_limiter.py --keys 1000000
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+from rate_limiter import create_rate_limiter
+
+
+def run(algorithm: str, keys: list[str], hot_keys: list[str], rounds: int, max_keys: int):
+    limiter = create_rate_limiter({
+        "max_attempts": 5,
+        "window_seconds": 10,
+        "algorithm": algorithm,
+        "max_keys": max_keys,
+    })
+
+    start = time.perf_counter()
+    for key in keys:
+        limiter.allow_attempt(key)
+    distinct_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for key in hot_keys:
+            limiter.allow_attempt(key)
+    hot_time = time.perf_counter() - start
+
+    tracemalloc.start()
+    for key in keys[:100_000]:
+        limiter.allow_attempt(key + "#mem")
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{algorithm:>15}: distinct {len(keys) / distinct_time:>12,.0f} ops/s | "
+          f"hot {rounds * len(hot_keys) / hot_time:>12,.0f} ops/s | "
+          f"{current / min(len(keys), 100_000):>5.0f} B/key | "
+          f"tracked keys {len(limiter.attempts):,}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument("--hot-keys", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--max-keys", type=int, default=0)
+    args = parser.parse_args()
+
+    keys = [f"user{i}@example.com" for i in range(args.keys)]
+    hot_keys = keys[:args.hot_keys]
+    for algorithm in ("deque", "sliding_window"):
+        run(algorithm, keys, hot_keys, args.rounds, args.max_keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Warm restart of persisted in-memory sessions.
+
+Creates sessions in a PersistentMemorySessionStore, closes it (writing a
+snapshot) and measures how long SessionManager.restore() takes to rebuild
+the in-memory indexes, once from the snapshot and once from an uncompacted log.
+A share of the sessions is already expired and must be skipped.
+
+    python benchmarks/bench_session_restore.py --sessions 1000000
+"""
+import argparse
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+from session_manager import SessionManager
+from session_store import PersistentMemorySessionStore
+
+
+def restore(path: str) -> tuple[int, float]:
+    manager = SessionManager(timeout=3600, store=PersistentMemorySessionStore(path))
+    start = time.perf_counter()
+    restored = manager.restore()
+    elapsed = time.perf_counter() - start
+    manager.store.log.close()
+    return restored, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--expired", type=float, default=0.1, help="share of already expired sessions")
+    args = parser.parse_args()
+
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+    now = time.time()
+    expired = int(args.sessions * args.expired)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "sessions.bin")
+        store = PersistentMemorySessionStore(path, compact_min_records=10 ** 12)
+        start = time.perf_counter()
+        for i in range(args.sessions):
+            expiry = now - 1 if i < expired else now + 3600
+            store.create(str(uuid.uuid4()), user_ids[i % args.users], expiry)
+        store.log.flush()
+        print(f"create:   {args.sessions} sessions in {time.perf_counter() - start:.2f}s")
+
+        restored, elapsed = restore(path)
+        print(f"log:      restored {restored} sessions in {elapsed:.3f}s "
+              f"({Path(path + '.log').stat().st_size / 2**20:.1f} MiB)")
+
+        start = time.perf_counter()
+        store.close()
+        print(f"compact:  {time.perf_counter() - start:.3f}s")
+
+        restored, elapsed = restore(path)
+        print(f"snapshot: restored {restored} sessions in {elapsed:.3f}s "
+              f"({Path(path).stat().st_size / 2**20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
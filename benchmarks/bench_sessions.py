@@ -0,0 +1,77 @@
+"""
+Benchmark for the SessionManager expiry engine.
+
+Creates a large number of sessions, lets them expire and measures how long
+creation, lookups, flag operations and eviction take and how much memory
+the live sessions hold.
+
+    python benchmarks/bench_sessions.py --sessions 2000000
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+from session_manager import SessionManager
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=200_000, help="sessions sampled for the lookup timings")
+    parser.add_argument("--trace-memory", action="store_true", help="measure allocations (slow)")
+    args = parser.parse_args()
+
+    manager = SessionManager(timeout=60)
+    tokens = [str(uuid.uuid4()) for _ in range(args.sessions)]
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    for i, token in enumerate(tokens):
+        manager.create_session(token, user_ids[i % args.users])
+    create_time = time.perf_counter() - start
+
+    if args.trace_memory:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"memory:   {current / 2**20:.1f} MiB ({current / args.sessions:.0f} B/session)")
+
+    print(f"create:   {args.sessions} sessions in {create_time:.2f}s "
+          f"({args.sessions / create_time:,.0f} ops/s)")
+    print(f"live:     {manager.live_sessions}")
+
+    sample = tokens[:: max(1, args.sessions // args.lookups)]
+    for label, op in (
+        ("active", lambda token: manager.is_session_active(token)),
+        ("user id", lambda token: manager.get_user_id(token)),
+        ("add flag", lambda token: manager.add_flag_by_token(token, "admin")),
+        ("has flag", lambda token: manager.session_has_flag(token, "admin")),
+    ):
+        start = time.perf_counter()
+        for token in sample:
+            op(token)
+        elapsed = time.perf_counter() - start
+        print(f"{label + ':':<10}{elapsed / len(sample) * 1e9:.0f} ns/op")
+
+    # Nothing has expired yet, a sweep must be cheap
+    start = time.perf_counter()
+    manager.evict_expired()
+    print(f"no-op sweep: {(time.perf_counter() - start) * 1e6:.1f}us")
+
+    start = time.perf_counter()
+    evicted = manager.evict_expired(now=time.time() + manager.timeout + 1)
+    evict_time = time.perf_counter() - start
+    print(f"evict:    {evicted} sessions in {evict_time:.2f}s "
+          f"({evict_time / max(evicted, 1) * 1e9:.0f} ns/session)")
+    print(f"live:     {manager.live_sessions}, evicted total: {manager.evicted_sessions}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Login lookup latency for growing user tables.
+
+Seeds a temporary users database per size and measures
+UserRepository.get_user_by_email (unique index on email_normalized)
+against the same lookup on the unindexed email column.
+
+    python benchmarks/bench_user_lookup.py --sizes 10000,1000000,10000000
+"""
+import argparse
+import asyncio
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from user_repository import UserRepository
+
+
+def seed(path: str, users: int, batch_size: int = 50000):
+    sync_engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(sync_engine)
+    sync_engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    now = "2025-01-01 00:00:00.000000"
+    for start in range(0, users, batch_size):
+        rows = [
+            (str(uuid.uuid4()), f"user{i}", f"User{i}@example.com", f"user{i}@example.com", "$SHA$x$y", now, now)
+            for i in range(start, min(start + batch_size, users))
+        ]
+        conn.executemany("INSERT INTO usermodel VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    conn.execute("PRAGMA user_version = 1")
+    conn.close()
+
+
+async def measure(path: str, users: int, lookups: int, indexed: bool) -> list[float]:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    repo = UserRepository(engine)
+    emails = [f"User{random.randrange(users)}@example.com" for _ in range(lookups)]
+    latencies = []
+    async with engine.connect() as conn:
+        for email in emails:
+            start = time.perf_counter()
+            if indexed:
+                user = await repo.get_user_by_email(email)
+            else:
+                # Previous behaviour: equality on a column without index
+                user = (await conn.execute(
+                    text("SELECT * FROM usermodel WHERE email = :email"), {"email": email}
+                )).first()
+            latencies.append(time.perf_counter() - start)
+            assert user is not None
+    await engine.dispose()
+    return latencies
+
+
+def report(label: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"  {label:>10}: p50 {p50:8.3f} ms | p99 {p99:8.3f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,1000000")
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--scan-lookups", type=int, default=20, help="lookups for the unindexed case")
+    args = parser.parse_args()
+
+    for users in (int(size) for size in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp) / "users.db")
+            start = time.perf_counter()
+            seed(path, users)
+            print(f"{users:,} users (seeded in {time.perf_counter() - start:.1f}s)")
+            report("indexed", await measure(path, users, args.lookups, indexed=True))
+            report("full scan", await measure(path, users, args.scan_lookups, indexed=False))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+"""
+Frontend login throughput against gatekeeper.
+
+Compares the previous webapp behaviour (a new httpx.AsyncClient per login)
+with the pooled GatekeeperClient, over TCP or a Unix domain socket.
+
+By default a gatekeeper is started with uvicorn on a temporary database, with
+the login rate limits lifted and SHA hashing (see bench_endpoints.write_config),
+so the client side is measured rather than rate limiting or the password KDF.
+Logins go round robin over `--users` seeded users.
+
+    python benchmarks/bench_webapp_login.py --logins 2000 --concurrency 32
+    python benchmarks/bench_webapp_login.py --uds /tmp/gatekeeper-bench.sock
+
+With `--url` the users are registered at an already running gatekeeper instead,
+whose rate limits apply: e.g. 5 attempts per email and 10 seconds need about
+`--logins / 5` users per run. The run fails if most logins are not answered with 200.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+
+from bench_endpoints import APP_DIR, PASSWORD, ROOT, seed, write_config
+
+sys.path.insert(0, str(ROOT / "webapp"))
+from gatekeeper_client import GatekeeperClient
+
+
+async def run(label: str, login, users: list[dict], logins: int, concurrency: int) -> int:
+    remaining = logins
+    failures = 0
+
+    async def worker():
+        nonlocal remaining, failures
+        while remaining > 0:
+            remaining -= 1
+            response = await login(users[remaining % len(users)])
+            if response.status_code != 200:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:>24}: {logins / elapsed:>8,.0f} logins/s ({failures} failed)")
+    return failures
+
+
+@asynccontextmanager
+async def start_gatekeeper(tmp: Path, args):
+    """
+    Runs gatekeeper with a benchmark config in a uvicorn subprocess.
+    Yields (url, api_token, users).
+    """
+    # The seeded users have SHA hashes, so logins neither run the KDF nor rehash
+    args.profile, args.algorithm = None, "sha"
+    config_path = write_config(tmp, args)
+    with open(config_path, "rb") as f:
+        config = tomllib.load(f)
+    address = ["--uds", args.uds] if args.uds else ["--host", "127.0.0.1", "--port", str(args.port)]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(APP_DIR), *address, "--log-level", "warning"],
+        cwd=ROOT, env=dict(os.environ, GATEKEEPER_CONFIG=str(config_path))
+    )
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        transport = httpx.AsyncHTTPTransport(uds=args.uds) if args.uds else None
+        async with httpx.AsyncClient(base_url=url, transport=transport) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/docs")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise SystemExit("uvicorn did not start")
+        # The tables exist once the app has started
+        users = [{"email": user["email"], "password": PASSWORD} for user in seed(tmp / "users.db", args.users)]
+        yield url, config["auth"]["valid_tokens"][0], users
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def register_users(url: str, api_token: str, args) -> list[dict]:
+    users = []
+    transport = httpx.AsyncHTTPTransport(uds=args.uds) if args.uds else None
+    async with httpx.AsyncClient(base_url=url, transport=transport, timeout=30) as client:
+        for _ in range(args.users):
+            name = f"bench_{uuid.uuid4().hex[:8]}"
+            user = {"username": name, "email": f"{name}@example.com", "password": "Bench1234"}
+            (await client.post("/register-user", json={"api_token": api_token, **user})).raise_for_status()
+            users.append({"email": user["email"], "password": user["password"]})
+    return users
+
+
+async def benchmark(url: str, api_token: str, users: list[dict], args) -> int:
+    async def login_new_client(user: dict):
+        # Previous webapp code: one client (and connection) per form post
+        transport = httpx.AsyncHTTPTransport(uds=args.uds) if args.uds else None
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.post(f"{url}/login-user", json={"api_token": api_token, **user})
+
+    gatekeeper = GatekeeperClient(url, api_token, max_connections=args.concurrency, uds=args.uds)
+    await gatekeeper.start()
+    try:
+        failures = await run("client per request", login_new_client, users, args.logins, args.concurrency)
+        failures += await run(
+            "pooled GatekeeperClient", lambda user: gatekeeper.login(user["email"], user["password"]),
+            users, args.logins, args.concurrency
+        )
+    finally:
+        await gatekeeper.close()
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="benchmark a running gatekeeper instead of starting one")
+    parser.add_argument("--api-token", default=None, help="with --url, default: the first of app/config.toml")
+    parser.add_argument("--uds", default=None)
+    parser.add_argument("--port", type=int, default=8765, help="port of the started gatekeeper")
+    parser.add_argument("--users", type=int, default=1000, help="number of users the logins are spread over")
+    parser.add_argument("--logins", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.url:
+        with open(APP_DIR / "config.toml", "rb") as f:
+            api_token = args.api_token or tomllib.load(f)["auth"]["valid_tokens"][0]
+        users = await register_users(args.url, api_token, args)
+        failures = await benchmark(args.url, api_token, users, args)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            async with start_gatekeeper(Path(tmp), args) as (url, api_token, users):
+                failures = await benchmark(url, api_token, users, args)
+
+    if failures > args.logins:
+        # More than half of both runs: the numbers would measure rejections
+        raise SystemExit(f"{failures} of {2 * args.logins} logins failed, e.g. rate limited; use more --users")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
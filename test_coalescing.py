@@ -0,0 +1,162 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+sys.path.insert(0, str(Path(__file__).parent / "app"))
+
+from db import create_engine
+from models import UserModel
+from user_repository import UserRepository
+
+BURST = 50
+
+
+async def make_repo(tmp_path) -> tuple[UserRepository, list]:
+    engine = create_engine({"url": f"sqlite+aiosqlite:///{tmp_path / 'users.db'}"})
+    repo = UserRepository(engine)
+    await repo.init_db()
+    for i in range(2):
+        await repo.save(UserModel(username=f"user{i}", email=f"User{i}@example.com", hashed_password="x"))
+
+    # Every SELECT on the users table the database sees
+    queries = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "usermodel" in statement:
+            queries.append(parameters)
+
+    return repo, queries
+
+
+def test_concurrent_lookups_share_one_query_per_key(tmp_path):
+    async def run():
+        repo, queries = await make_repo(tmp_path)
+        user = await repo.get_user_by_username("user0")
+        queries.clear()
+
+        async def login_lookup(email):
+            async with repo.unit_of_work() as uow:
+                return await uow.get_user_by_email(email)
+
+        lookups = (
+            [repo.get_user_by_id(user.id) for _ in range(BURST)]
+            + [repo.get_user_by_email("user1@EXAMPLE.com") for _ in range(BURST)]
+            + [login_lookup("user1@example.com") for _ in range(BURST)]
+            + [repo.get_user_by_username("nobody") for _ in range(BURST)]
+        )
+        results = await asyncio.gather(*lookups)
+        await repo.engine.dispose()
+        return repo, queries, user, results
+
+    repo, queries, user, results = asyncio.run(run())
+
+    # id, email (repository and unit of work) and the unknown username
+    assert len(queries) == 3
+    assert repo.coalesced_queries == 4 * BURST - 3
+    assert not repo.in_flight
+    assert all(u.id == user.id for u in results[:BURST])
+    assert all(u.username == "user1" for u in results[BURST:3 * BURST])
+    assert all(u is None for u in results[3 * BURST:])
+    # Callers get their own instances
+    assert len({id(u) for u in results[:BURST]}) == BURST
+
+
+def test_error_reaches_every_waiter(tmp_path):
+    async def run():
+        repo, queries = await make_repo(tmp_path)
+        calls = 0
+
+        async def failing_query(condition):
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise RuntimeError("database is locked")
+
+        repo._query = failing_query
+        results = await asyncio.gather(
+            *(repo.get_user_by_username("user0") for _ in range(BURST)), return_exceptions=True
+        )
+        await repo.engine.dispose()
+        return repo, calls, results
+
+    repo, calls, results = asyncio.run(run())
+
+    assert calls == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert not repo.in_flight
+
+
+def test_lookup_after_write_does_not_join_older_query(tmp_path):
+    async def run():
+        repo, queries = await make_repo(tmp_path)
+        user = await repo.get_user_by_username("user0")
+        queries.clear()
+
+        # Keep the first query in flight until the write is done
+        release = asyncio.Event()
+        query = repo._query
+
+        async def gated_query(condition):
+            await release.wait()
+            return await query(condition)
+
+        repo._query = gated_query
+        first = asyncio.ensure_future(repo.get_user_by_id(user.id))
+        await asyncio.sleep(0)
+        assert repo.in_flight
+        user.username = "renamed"
+        await repo.update(user)
+        second = asyncio.ensure_future(repo.get_user_by_id(user.id))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, second)
+        await repo.engine.dispose()
+        return repo, queries, second.result()
+
+    repo, queries, second = asyncio.run(run())
+
+    assert second.username == "renamed"
+    assert repo.coalesced_queries == 0
+    assert len(queries) == 2
+
+
+def test_write_to_other_user_keeps_query_shared(tmp_path):
+    async def run():
+        repo, queries = await make_repo(tmp_path)
+        user = await repo.get_user_by_username("user0")
+        other = await repo.get_user_by_username("user1")
+        queries.clear()
+
+        release = asyncio.Event()
+        query = repo._query
+
+        async def gated_query(condition):
+            await release.wait()
+            return await query(condition)
+
+        repo._query = gated_query
+        first = asyncio.ensure_future(repo.get_user_by_email("user0@example.com"))
+        await asyncio.sleep(0)
+        # Neither writes a key the email lookup of user0 depends on
+        other.username = "renamed"
+        await repo.update(other)
+        await repo.update_last_access({user.id: other.last_access})
+        second = asyncio.ensure_future(repo.get_user_by_email("user0@example.com"))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, second)
+        await repo.engine.dispose()
+        return repo, queries
+
+    repo, queries = asyncio.run(run())
+
+    assert repo.coalesced_queries == 1
+    assert len(queries) == 1
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
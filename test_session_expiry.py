@@ -0,0 +1,62 @@
+import asyncio
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "app"))
+
+from session_manager import SessionManager
+from session_store import MemorySessionStore
+
+
+def test_extending_does_not_grow_the_queue():
+    store = MemorySessionStore()
+    now = time.time()
+    tokens = [str(uuid.uuid4()) for _ in range(100)]
+    for token in tokens:
+        store.create(token, str(uuid.uuid4()), now + 10)
+    for i in range(50):
+        for token in tokens[:50]:
+            store.set_expiry(token, now + 11 + i, now)
+    assert len(store.expiry_queue) == len(tokens)
+
+    # The sessions that were not extended expire, the others are queued at their new expiry
+    assert store.evict_expired(now + 10.5) == 50
+    assert store.count() == 50
+    assert len(store.expiry_queue) == 50
+    assert store.evict_expired(now + 59) == 0
+    assert store.evict_expired(now + 60) == 50
+    assert not store.expiry_queue
+
+
+def test_sweep_evicts_in_batches():
+    async def run():
+        manager = SessionManager(timeout=1)
+        now = time.time()
+        for _ in range(2500):
+            manager.store.create(str(uuid.uuid4()), str(uuid.uuid4()), now - 1)
+        # Live sessions after each step of the sweep, as other tasks see them
+        seen = []
+
+        async def observe():
+            while manager.live_sessions:
+                seen.append(manager.live_sessions)
+                await asyncio.sleep(0)
+
+        observer = asyncio.create_task(observe())
+        sweep = asyncio.create_task(manager.run_expiry_loop(interval=60, batch_size=1000))
+        await observer
+        sweep.cancel()
+        return manager, seen
+
+    manager, seen = asyncio.run(run())
+
+    assert manager.evicted_sessions == 2500
+    assert seen == [2500, 1500, 500]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,125 @@
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "app"))
+
+from session_log import RECORD
+from session_store import PersistentMemorySessionStore
+
+
+def state(store: PersistentMemorySessionStore) -> dict:
+    """Sessions that have not expired, as restore() would bring them back."""
+    now = time.time()
+    sessions = {}
+    for token, session in store.tokens.items():
+        if session["expiry"] > now:
+            sessions[token] = (session["user_id"], session["expiry"], sorted(session["flags"]))
+    return sessions
+
+
+def reload(path: str, now: float) -> PersistentMemorySessionStore:
+    store = PersistentMemorySessionStore(path)
+    store.load(now)
+    return store
+
+
+def make_changes(store: PersistentMemorySessionStore, now: float) -> list[str]:
+    """Creates, extends, flags and deletes sessions, returns the tokens created."""
+    user_ids = [str(uuid.uuid4()) for _ in range(3)]
+    tokens = [str(uuid.uuid4()) for _ in range(6)]
+    for i, token in enumerate(tokens):
+        store.create(token, user_ids[i % 3], now + 100 + i)
+    store.set_expiry(tokens[0], now + 500, now)
+    store.add_flag(tokens[1], "admin")
+    store.add_flag(tokens[1], "mfa")
+    store.remove_flag(tokens[1], "admin")
+    store.add_flag(tokens[2], "admin")
+    store.delete(tokens[3])
+    store.delete_user(user_ids[2])
+    # Already expired, must not be restored
+    store.create(str(uuid.uuid4()), user_ids[0], now - 1)
+    return tokens
+
+
+def test_log_round_trip(tmp_path):
+    path = str(tmp_path / "sessions.bin")
+    now = time.time()
+    store = PersistentMemorySessionStore(path)
+    make_changes(store, now)
+    expected = state(store)
+    store.log.flush()
+
+    restored = reload(path, now)
+    assert state(restored) == expected
+    assert len(expected) == 3
+
+
+def test_torn_tail_record(tmp_path):
+    path = str(tmp_path / "sessions.bin")
+    now = time.time()
+    store = PersistentMemorySessionStore(path)
+    make_changes(store, now)
+    expected = state(store)
+    store.log.close()
+    # A crash in the middle of a record
+    with open(path + ".log", "ab") as f:
+        f.write(b"\x01" * (RECORD.size // 2))
+
+    restored = reload(path, now)
+    assert state(restored) == expected
+    # Records appended after the torn one stay aligned
+    token = str(uuid.uuid4())
+    restored.create(token, str(uuid.uuid4()), now + 100)
+    restored.log.close()
+    assert token in state(reload(path, now))
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_snapshot_then_log(tmp_path, background):
+    path = str(tmp_path / "sessions.bin")
+    now = time.time()
+    store = PersistentMemorySessionStore(path)
+    tokens = make_changes(store, now)
+    store.compact(background=background)
+    # Changes after the snapshot go to the new log, also while it is being written
+    store.set_expiry(tokens[1], now + 900, now)
+    store.remove_flag(tokens[1], "mfa")
+    store.add_flag(tokens[4], "support")
+    store.delete(tokens[2])
+    if store.compaction:
+        store.compaction.result()
+    store.log.flush()
+    expected = state(store)
+
+    restored = reload(path, now)
+    assert state(restored) == expected
+    assert not Path(path + ".log.prev").exists()
+
+
+def test_crash_before_snapshot_is_written(tmp_path):
+    path = str(tmp_path / "sessions.bin")
+    now = time.time()
+    store = PersistentMemorySessionStore(path)
+    tokens = make_changes(store, now)
+    store.compact()
+    store.add_flag(tokens[0], "admin")
+    # Log moved aside, but the snapshot never written
+    store.log.rotate()
+    store.delete(tokens[4])
+    store.log.flush()
+    expected = state(store)
+
+    restored = reload(path, now)
+    assert state(restored) == expected
+    # The next snapshot takes over the old log
+    restored.close()
+    assert not Path(path + ".log.prev").exists()
+    assert state(reload(path, now)) == expected
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,88 @@
+import asyncio
+from typing import Optional
+import httpx
+
+
+class GatekeeperClient:
+    """
+    Shared HTTP client for the gatekeeper API.
+
+    Keeps a pool of keep-alive connections for the lifetime of the webapp
+    (start/close are called from the app lifespan). With `uds`, requests go
+    over a Unix domain socket instead of TCP.
+    Requests are retried with exponential backoff only if the connection could
+    not be established, so a login is never sent twice.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 5.0,
+        retries: int = 2,
+        backoff: float = 0.05,
+        uds: Optional[str] = None,
+    ):
+        self.base_url = base_url
+        self.api_token = api_token
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.uds = uds or None
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        transport = httpx.AsyncHTTPTransport(limits=self.limits, uds=self.uds)
+        self.client = httpx.AsyncClient(base_url=self.base_url, transport=transport, timeout=self.timeout)
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def post(self, path: str, data: dict, headers: Optional[dict] = None) -> httpx.Response:
+        if self.client is None:
+            await self.start()
+        payload = {"api_token": self.api_token, **data}
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.client.post(path, json=payload, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def login(self, email: str, password: str, client_ip: Optional[str] = None) -> httpx.Response:
+        # Passes the user's address on, so gatekeeper's per-IP limit does not hit the webapp itself
+        headers = {"X-Forwarded-For": client_ip} if client_ip else None
+        return await self.post("/login-user", {"email": email, "password": password}, headers=headers)
+
+    async def validate_session(self, session_token: str, extend: bool = False) -> httpx.Response:
+        return await self.post("/validate-session", {"session_token": session_token, "extend": extend})
+
+
+def create_gatekeeper_client(config: dict) -> GatekeeperClient:
+    """
+    Builds the client from the [server] and [webapp] sections of app/config.toml.
+    """
+    server = config["server"]
+    conf = config.get("webapp", {})
+    return GatekeeperClient(
+        base_url=f"http://{server['host']}:{server['port']}",
+        api_token=config["auth"]["valid_tokens"][0],
+        max_connections=conf.get("max_connections", 100),
+        max_keepalive_connections=conf.get("max_keepalive_connections", 20),
+        keepalive_expiry=conf.get("keepalive_expiry", 30.0),
+        timeout=conf.get("timeout", 5.0),
+        retries=conf.get("retries", 2),
+        backoff=conf.get("backoff", 0.05),
+        uds=server.get("uds") or None,
+    )
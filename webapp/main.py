@@ -1,21 +1,45 @@
-from fastapi import FastAPI, Request, Form
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Request, Form
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
-import httpx
+from gatekeeper_client import create_gatekeeper_client
+from session_validation import create_session_validator
 import tomllib
 
-app = FastAPI()
-templates = Jinja2Templates(directory="templates")
-
 CONFIG_PATH = Path(__file__).parent.parent / "app" / "config.toml"
 with open(CONFIG_PATH, "rb") as f:
     config = tomllib.load(f)
 
-# Zugriff auf Gatekeeper-URL
-host = config["server"]["host"]
-port = config["server"]["port"]
-gatekeeper_url = f"http://{host}:{port}"
+# Zugriff auf Gatekeeper (gemeinsamer Client mit Connection-Pool)
+gatekeeper = create_gatekeeper_client(config)
+session_validator = create_session_validator(config, gatekeeper)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await gatekeeper.start()
+    yield
+    await gatekeeper.close()
+
+app = FastAPI(lifespan=lifespan)
+templates = Jinja2Templates(directory="templates")
+
+class NotAuthenticated(Exception):
+    pass
+
+@app.exception_handler(NotAuthenticated)
+async def not_authenticated_handler(request: Request, exc: NotAuthenticated):
+    return RedirectResponse(url="/")
+
+async def require_session(request: Request) -> str:
+    """
+    Dependency for protected routes, returns the user id of the session cookie.
+    """
+    token = request.cookies.get("session_token")
+    user_id = await session_validator.validate(token) if token else None
+    if not user_id:
+        raise NotAuthenticated()
+    return user_id
 
 @app.get("/", response_class=HTMLResponse)
 async def show_login(request: Request):
@@ -35,12 +59,8 @@ async def login_submit(
     password: str = Form(...),
     redirect: str = Form("/")
     ):
-    async with httpx.AsyncClient() as client:
-        api_response = await client.post(f"{gatekeeper_url}/login-user", json={
-            "api_token": config["auth"]["valid_tokens"][0],
-            "email": email,
-            "password": password
-        })
+    client_ip = request.client.host if request.client else None
+    api_response = await gatekeeper.login(email, password, client_ip)
     if not redirect.startswith("/") or redirect.endswith("login"):
         redirect = "/welcome"
     if api_response.status_code == 200:
@@ -55,13 +75,11 @@ async def login_submit(
     return response
 
 @app.get("/welcome", response_class=HTMLResponse)
-async def welcome(request: Request):
-    token = request.cookies.get("session_token")
-    if not token:
-        return RedirectResponse(url="/")
+async def welcome(request: Request, user_id: str = Depends(require_session)):
     return templates.TemplateResponse("welcome.html", {"request": request})
 
 if __name__ == "__main__":
     import uvicorn
     host = config["server"].get("host", "127.0.0.1")
-    uvicorn.run("main:app", host=host, port=80, reload=False)
\ No newline at end of file
+    port = config["server"].get("webservice_port", 80)
+    uvicorn.run("main:app", host=host, port=port, reload=False)
\ No newline at end of file
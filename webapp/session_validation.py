@@ -0,0 +1,78 @@
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+from gatekeeper_client import GatekeeperClient
+
+
+class SessionValidator:
+    """
+    Checks session cookies of protected routes against gatekeeper's /validate-session.
+
+    Positive results are cached for `ttl_seconds` (at most until the session
+    expires), so a page with several protected requests costs one round trip.
+    A session closed in gatekeeper is therefore still accepted here for up to
+    `ttl_seconds`. Failed validations are never cached.
+
+    With a `signer` (token_mode = "signed"), tokens are checked locally without
+    any request. Revocations by logout are not visible to the webapp in that mode.
+    """
+
+    def __init__(self, gatekeeper: GatekeeperClient, ttl_seconds: float = 5, max_entries: int = 10000, signer=None):
+        self.gatekeeper = gatekeeper
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.signer = signer
+        # token -> (valid_until, user_id), oldest first
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def validate(self, token: str) -> Optional[str]:
+        """
+        Returns the user id of an active session, otherwise None.
+        """
+        if self.signer:
+            claims = self.signer.verify(token)
+            if claims is None or claims["expiry"] <= time.time():
+                return None
+            return claims["user_id"]
+
+        now = time.time()
+        entry = self.entries.get(token)
+        if entry is not None:
+            if entry[0] > now:
+                return entry[1]
+            del self.entries[token]
+
+        response = await self.gatekeeper.validate_session(token)
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        if self.ttl_seconds > 0:
+            self.entries[token] = (min(now + self.ttl_seconds, data["expiry"]), data["user_id"])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return data["user_id"]
+
+    def forget(self, token: str):
+        self.entries.pop(token, None)
+
+
+def create_session_validator(config: dict, gatekeeper: GatekeeperClient) -> SessionValidator:
+    """
+    Builds the validator from the [auth] and [webapp] sections of app/config.toml.
+    """
+    conf = config.get("webapp", {})
+    auth = config.get("auth", {})
+    signer = None
+    if conf.get("validate_signed_locally", False) and auth.get("token_mode", "opaque") == "signed":
+        # signed_tokens liegt in app/; angehaengt, damit webapp/main.py Vorrang vor app/main.py behaelt
+        sys.path.append(str(Path(__file__).parent.parent / "app"))
+        from signed_tokens import TokenSigner, signing_key
+        signer = TokenSigner(signing_key(auth))
+    return SessionValidator(
+        gatekeeper,
+        ttl_seconds=conf.get("session_cache_ttl", 5),
+        max_entries=conf.get("session_cache_max_entries", 10000),
+        signer=signer,
+    )